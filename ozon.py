@@ -1,414 +1,95 @@
 import streamlit as st
-import pandas as pd
-import re
 import io
-from pypdf import PdfReader, PdfWriter
+import os
+import threading
 from datetime import datetime
-from openpyxl.styles import Font, Alignment
-from openpyxl.utils import get_column_letter
-
-FBS_PREFIXES = {
-    "Озон": "204514",
-    "Рига": "2503733",
-    "Плутон": "3021812"
+from functools import partial
+
+# Модуль обработки ozon_core (pandas, pypdf, openpyxl) здесь не импортируется: он загружается функцией core()
+# после загрузки файлов или заранее, в фоновом прогреве, — страница показывается без ожидания этих импортов.
+from ozon_config import DEFAULT_PDF_WORKERS, DEFAULT_STICKER_INDEX_DIR, FBS_PREFIXES, RESULT_CACHE_MAX_BYTES, WARM_UP
+from ozon_jobs import JOB_CANCELLED, JOB_DONE, JOB_FAILED, JOB_QUEUED, cancel_job, get_job, new_job_queue, submit_job
+
+# Пункт выбора склада, при котором склад определяется по стикерам в PDF.
+AUTO_FBS_OPTION = "Определить по PDF"
+
+# Названия этапов обработки для индикатора хода задачи.
+STAGE_LABELS = {
+    'csv_read': "Чтение CSV",
+    'sort': "Сортировка заказов",
+    'pdf_open': "Открытие PDF",
+    'pdf_extract': "Поиск стикеров в PDF",
+    'delta': "Отбор новых страниц",
+    'match': "Сопоставление стикеров",
+    'excel': "Выгрузка Excel",
+    'pdf_write': "Запись PDF",
 }
 
+# Как часто страница опрашивает состояние задачи, секунд.
+JOB_POLL_SECONDS = 1
 
-def extract_order_number_prefix(order_string):
-    """Извлекает префикс номера заказа."""
-    if not isinstance(order_string, str):
-        order_string = str(order_string)
-    match = re.search(r'^(\d+)-', order_string)
-    if match:
-        return match.group(1)
-    else:
-        return None
-
+# Если задан путь, замеры этапов каждого запуска дописываются в этот файл JSON Lines.
+METRICS_LOG_PATH = os.environ.get("OZON_METRICS_LOG")
 
-def extract_sticker_from_order(order_number):
-    """Извлекает стикер из номера заказа."""
-    if not isinstance(order_number, str):
-        order_number = str(order_number)
-    match = re.search(r'(\d{4})-', order_number)
-    if match:
-        return match.group(1)
-    else:
-        return None
-
-
-def sort_dataframe(df):
-    """Сортирует DataFrame в соответствии с заданными приоритетами."""
-    required_cols = ['Артикул', 'Количество', 'Наименование товара', 'Номер отправления', 'Стикер']
-    for col in required_cols:
-        if col not in df.columns:
-            df[col] = ''
-
-    df['Количество'] = pd.to_numeric(df['Количество'], errors='coerce').fillna(0)
-    original_article_case = df['Артикул'].astype(str)
-    df['Артикул_lower'] = df['Артикул'].astype(str).str.lower()
-    df['Наименование товара_lower'] = df['Наименование товара'].astype(str).str.lower()
-
-    def get_article_core(article):
-        """Извлекает основную часть артикула, убирая суффиксы."""
-        match = re.search(r'([a-z]\d+)$', article)
-        if match:
-            end_of_core = match.start()
-            return article[:end_of_core].strip()
-        else:
-            return article.strip()
-
-    df['article_core'] = df['Артикул_lower'].apply(get_article_core)
-    core_counts = df['article_core'].value_counts()
-    df['core_repeat_count'] = df['article_core'].map(core_counts)
-    sticker_counts = df['Артикул_lower'].value_counts()
-    df['full_sticker_repeat_count'] = df['Артикул_lower'].map(sticker_counts)
-
-    df['shipment_sticker_key'] = df['Номер отправления'].astype(str) + '_' + df['Стикер'].astype(str)
-    shipment_sticker_counts = df['shipment_sticker_key'].value_counts()
-    df['shipment_sticker_repeated'] = df['shipment_sticker_key'].map(shipment_sticker_counts)
-    df['shipment_sticker_repeated_flag'] = df['shipment_sticker_repeated'] > 1
-
-    df['has_k_prefix_num'] = df['Артикул_lower'].str.contains(r'.*[k][2-5]\d*.*', na=False)
-    df['qty_greater_than_1'] = df['Количество'] > 1
-    df['article_repeated'] = df['full_sticker_repeat_count'] > 1
-
-    df['name_article_key'] = df['Наименование товара_lower'].astype(str) + '_' + df['Артикул_lower'].astype(str)
-    name_article_counts = df['name_article_key'].value_counts()
-    df['name_article_repeated'] = df['name_article_key'].map(name_article_counts)
-
-    df['k_num_suffix'] = 0
-    k_match = df['Артикул_lower'].str.extract(r'.*[k]([2-6]\d*)$', expand=False)
-    df['k_num_suffix'] = pd.to_numeric(k_match, errors='coerce').fillna(0)
-
-    df['sort_level'] = 4.0
-    priority1_mask = (df['core_repeat_count'] > 1) & (df['has_k_prefix_num'])
-    df.loc[priority1_mask, 'sort_level'] = 1.0
-    priority2_mask = (df['full_sticker_repeat_count'] > 1) & (df['qty_greater_than_1']) & (df['sort_level'] == 4.0)
-    df.loc[priority2_mask, 'sort_level'] = 2.0
-    priority3_mask = (df['full_sticker_repeat_count'] > 1) & (df['sort_level'] == 4.0)
-    df.loc[priority3_mask, 'sort_level'] = 3.0
-
-    df = df.sort_values(
-        by=[
-            'shipment_sticker_repeated_flag',  # Приоритет 1: Повторение "Номер отправления" и "Стикер"
-            'has_k_prefix_num',  # Приоритет 2: Наличие k/K с числом
-            'k_num_suffix',  # Сортировка по номеру после k/K (убывание)
-            'qty_greater_than_1',  # Приоритет 3: Количество > 1
-            'article_repeated',  # Приоритет 4: Повторяющийся артикул
-            'name_article_repeated',  # Приоритет 5: Повторение "Наименование товара" и "Артикул" (убывание)
-            'sort_level',  # Остальные критерии
-            'article_core',
-            'core_repeat_count',
-            'Количество',
-            'core_repeat_count',
-            'Наименование товара_lower',
-            'Артикул_lower'
-        ],
-        ascending=[
-            False,  # 'shipment_sticker_repeated_flag': Сначала True (повторяется)
-            False,  # 'has_k_prefix_num': Сначала True (есть k/K)
-            False,  # 'k_num_suffix':  Убывание (сначала больше)
-            False,  # 'qty_greater_than_1': Сначала True (Количество > 1)
-            False,  # 'article_repeated': Сначала True (повторяется)
-            False,  # 'name_article_repeated': По убыванию (сначала больше)
-            True,  # 'sort_level':  По возрастанию
-            True,
-            False,
-            False,
-            False,
-            True,
-            True
-        ]
-    )
 
-    df['Артикул'] = original_article_case
-    return df
+def core():
+    """Модуль обработки; при первом вызове импортируется (если его ещё не загрузил прогрев)."""
+    import ozon_core
+    return ozon_core
 
 
-def extract_sticker_data_from_pdf(pdf_file, fbs_prefix):
-    """Извлекает данные стикеров из PDF."""
-    sticker_data = {}
+def warm_up_core():
+    """Загружает и прогревает модуль обработки, пока пользователь выбирает файлы; ошибки прогрева не важны."""
     try:
-        reader = PdfReader(pdf_file)
-        for page_num, page in enumerate(reader.pages):
-            text = page.extract_text()
-            if text:
-                pattern = r"FBS:\s*" + re.escape(fbs_prefix) + r"\s*(\d+)"
-                match = re.search(pattern, text)
-
-                if match:
-                    sticker_number = match.group(1)
-                    sticker_data[page_num + 1] = sticker_number
-                else:
-                    pass
-            else:
-                pass
-    except Exception as e:
-        st.error(f"Ошибка при обработке PDF файла: {e}")
-    return sticker_data
+        core().warm_up()
+    except Exception:
+        pass
 
 
-def reorder_pdf_pages(pdf_file, page_order_mapping):
-    """Переупорядочивает страницы PDF."""
-    try:
-        reader = PdfReader(pdf_file)
-        writer = PdfWriter()
-        pages_dict = {i + 1: page for i, page in enumerate(reader.pages)}
-        for original_page_num, _ in page_order_mapping:
-            if original_page_num not in pages_dict:
-                st.error(f"Страница {original_page_num} из PDF не найдена. Проверьте соответствие стикеров.")
-                return None
-        for original_page_num, _ in page_order_mapping:
-            page_to_add = pages_dict[original_page_num]
-            writer.add_page(page_to_add)
-        return writer
-    except Exception as e:
-        st.error(f"Ошибка при переупорядочивании страниц PDF: {e}")
-        return None
-
-
-def get_last_4_digits(value):
-    """Извлекает последние 4 цифры из значения."""
-    if pd.isna(value):
-        return ""
-    value_str = str(value)
-    match = re.search(r'(\d{4})$', value_str)
-    if match:
-        return match.group(0)
-    else:
-        digits_only = "".join(filter(str.isdigit, value_str))
-        if len(digits_only) >= 4:
-            return digits_only[-4:]
-        else:
-            return ""
+@st.cache_resource
+def start_warm_up():
+    """Запускает прогрев один раз на процесс, в фоновом потоке."""
+    thread = threading.Thread(target=warm_up_core, name='ozon-warm-up', daemon=True)
+    thread.start()
+    return thread
 
 
-def customize_excel(df, df_repeats, fbs_option, num_pdf_pages):
-    """Настраивает Excel файл."""
-    try:
-        excel_buffer = io.BytesIO()
-        with pd.ExcelWriter(excel_buffer, engine='openpyxl') as writer:
-            # === Лист 1: Основной ===
-            sheet_name_main = 'Лист подбора'
-            df.to_excel(writer, sheet_name=sheet_name_main, index=False, startrow=5)
-            sheet_main = writer.sheets[sheet_name_main]
-
-            # === Заголовки и инфо для основного листа ===
-            sheet_main['B1'] = f'Лист подбора OZON'
-            sheet_main['B1'].font = Font(bold=True, size=16)
-
-            sheet_main['B2'] = f'Склад: {fbs_option}'
-            sheet_main['B2'].font = Font(bold=True, size=13)
-
-            sheet_main['B3'] = 'Дата: ' + datetime.now().strftime("%Y-%m-%d %H:%M")
-            sheet_main['B3'].font = Font(bold=True, size=13)
-
-            sheet_main['B4'] = f'Количество отправлений: {num_pdf_pages}'
-            sheet_main['B4'].font = Font(bold=True, size=13)
-
-            # === Настройки печати для основного листа ===
-            sheet_main.page_setup.orientation = 'landscape'
-            sheet_main.page_setup.paperSize = 9
-            sheet_main.page_margins.left = 0
-            sheet_main.page_margins.right = 0
-            sheet_main.page_margins.top = 0
-            sheet_main.page_margins.bottom = 0
-            sheet_main.page_margins.header = 0
-            sheet_main.page_margins.footer = 0
-
-            sheet_main.sheet_view.fitToPage = True
-            sheet_main.sheet_view.zoomScale = 100
-            sheet_main.sheet_view.zoomToFit = True
-
-            # === Лист 2: Повторы ===
-            if not df_repeats.empty:
-                repeats_sheet_name = 'Повторы'
-
-                df_repeats_processed = df_repeats.copy()
-                seen_stickers = set()
-                for index, row in df_repeats_processed.iterrows():
-                    sticker = row['Стикер']
-                    if sticker in seen_stickers:
-                        row['Стикер'] = ''
-                    else:
-                        seen_stickers.add(sticker)
-                    df_repeats_processed.loc[index] = row
-
-                df_repeats_processed.to_excel(writer, sheet_name=repeats_sheet_name, index=False, startrow=5)
-                sheet_repeats = writer.sheets[repeats_sheet_name]
-
-                # === Заголовки и инфо для листа повторов ===
-                sheet_repeats['B1'] = f'Повторяющиеся заказы'
-                sheet_repeats['B1'].font = Font(bold=True, size=16)
-
-                sheet_repeats['B2'] = f'Склад: {fbs_option}'
-                sheet_repeats['B2'].font = Font(bold=True, size=13)
-
-                sheet_repeats['B3'] = 'Дата: ' + datetime.now().strftime("%Y-%m-%d %H:%M")
-                sheet_repeats['B3'].font = Font(bold=True, size=13)
-
-                # === Настройки печати для листа повторов ===
-                sheet_repeats.page_setup.orientation = 'landscape'
-                sheet_repeats.page_setup.paperSize = 9
-                sheet_repeats.page_margins.left = 0
-                sheet_repeats.page_margins.right = 0
-                sheet_repeats.page_margins.top = 0
-                sheet_repeats.page_margins.bottom = 0
-                sheet_repeats.page_margins.header = 0
-                sheet_repeats.page_margins.footer = 0
-
-                sheet_repeats.sheet_view.fitToPage = True
-                sheet_repeats.sheet_view.zoomScale = 100
-                sheet_repeats.sheet_view.zoomToFit = True
-
-                # === Стилизация листа повторов ===
-                header_font = Font(bold=True)
-                header_alignment = Alignment(horizontal='center')
-                data_alignment = Alignment(horizontal='left')
-
-                for col_num in range(1, df_repeats_processed.shape[1] + 1):
-                    cell = sheet_repeats.cell(row=6, column=col_num)
-                    cell.font = header_font
-                    cell.alignment = header_alignment
-
-                for row_num in range(7, sheet_repeats.max_row + 1):
-                    for col_num in range(1, df_repeats_processed.shape[1] + 1):
-                        cell = sheet_repeats.cell(row=row_num, column=col_num)
-                        cell.alignment = data_alignment
-                        if sheet_repeats.cell(row=6, column=col_num).value == 'Кол-во':
-                            if isinstance(cell.value, (int, float)) and cell.value > 1:
-                                cell.font = Font(bold=True)
-
-                for col_num in range(1, df_repeats_processed.shape[1] + 1):
-                    column_letter = get_column_letter(col_num)
-                    max_length = 0
-                    for row_num in range(6, sheet_repeats.max_row + 1):
-                        cell = sheet_repeats[column_letter + str(row_num)]
-                        if cell.value is not None:
-                            max_length = max(max_length, len(str(cell.value)))
-                    header_cell = sheet_repeats[column_letter + '6']
-                    if header_cell.value is not None:
-                        max_length = max(max_length, len(str(header_cell.value)))
-                    sheet_repeats.column_dimensions[column_letter].width = max_length + 2
-
-                # === Заморозка области для листа повторов ===
-                sheet_repeats.freeze_panes = 'A7'
-
-            # === Стилизация основного листа ===
-            header_font = Font(bold=True)
-            header_alignment = Alignment(horizontal='center')
-            data_alignment = Alignment(horizontal='left')
-
-            for col_num in range(1, df.shape[1] + 1):
-                cell = sheet_main.cell(row=6, column=col_num)
-                cell.font = header_font
-                cell.alignment = header_alignment
-
-            for row_num in range(7, sheet_main.max_row + 1):
-                for col_num in range(1, df.shape[1] + 1):
-                    cell = sheet_main.cell(row=row_num, column=col_num)
-                    cell.alignment = data_alignment
-
-                    if sheet_main.cell(row=6, column=col_num).value == 'Кол-во':
-                        if isinstance(cell.value, (int, float)) and cell.value > 1:
-                            cell.font = Font(bold=True)
-
-            for col_num in range(1, df.shape[1] + 1):
-                column_letter = get_column_letter(col_num)
-                max_length = 0
-                for row_num in range(6, sheet_main.max_row + 1):
-                    cell = sheet_main[column_letter + str(row_num)]
-                    if cell.value is not None:
-                        max_length = max(max_length, len(str(cell.value)))
-                header_cell = sheet_main[column_letter + '6']
-                if header_cell.value is not None:
-                    max_length = max(max_length, len(str(header_cell.value)))
-
-                sheet_main.column_dimensions[column_letter].width = max_length + 2
-
-            # === Заморозка области для основного листа ===
-            sheet_main.freeze_panes = 'A7'
-
-        excel_buffer.seek(0)
-        return excel_buffer
-
-    except Exception as e:
-        st.error(f"Произошла ошибка при настройке Excel файла: {e}")
-        st.error(f"Тип ошибки: {type(e)}")
-        st.error(f"Аргументы ошибки: {e.args}")
-        st.exception(e)
-        return None
-
-
-def read_csv_with_encoding(uploaded_csv_file):
-    """
-    Пытается прочитать CSV файл с разными кодировками и определяет столбец 'Наименование товара'.
-    """
-    encodings_to_try = ['utf-8', 'cp1251', 'latin1']
-    sep_options = [';', ',', '\t']
-    possible_name_columns = ['Наименование товара', 'Название товара']
-
-    for sep in sep_options:
-        for encoding in encodings_to_try:
-            try:
-                df = pd.read_csv(uploaded_csv_file, sep=sep, encoding=encoding)
-                # st.write(f"Файл успешно прочитан с кодировкой '{encoding}' и разделителем '{sep}'")
-
-                name_column = None
-                for col in possible_name_columns:
-                    if col in df.columns:
-                        name_column = col
-                        break
-
-                if name_column is None:
-                    st.error(f"Не найден столбец с наименованием товара. Проверены: {possible_name_columns}")
-                    # st.write("Список столбцов в DataFrame:")
-                    st.write(df.columns.tolist())
-                    return None
-
-                if name_column != 'Наименование товара':
-                    df = df.rename(columns={name_column: 'Наименование товара'})
-                    # st.write(f"Столбец '{name_column}' переименован в 'Наименование товара'")
-
-                # st.write("Список столбцов в DataFrame:")
-                # st.write(df.columns.tolist())
-                return df
-
-            except UnicodeDecodeError:
-                st.write(f"Ошибка UnicodeDecodeError при чтении с кодировкой '{encoding}' и разделителем '{sep}'")
-                pass
-            except Exception as e:
-                st.write(f"Другая ошибка при чтении с разделителем '{sep}' и кодировкой '{encoding}': {e}")
-                pass
+@st.cache_resource
+def get_result_cache():
+    """Кэш результатов, общий для всех перезапусков скрипта и всех сессий."""
+    return core().new_result_cache(RESULT_CACHE_MAX_BYTES)
 
-    try:
-        uploaded_csv_file.seek(0)
-        df = pd.read_csv(io.StringIO(uploaded_csv_file.read().decode('cp1251')))
 
-        name_column = None
-        for col in possible_name_columns:
-            if col in df.columns:
-                name_column = col
-                break
+@st.cache_resource
+def get_job_queue():
+    """Очередь фоновых задач, общая для всех сессий: одновременно выполняется не больше DEFAULT_MAX_JOBS задач."""
+    return new_job_queue()
+
 
-        if name_column is None:
-            st.error(f"Не найден столбец с наименованием товара (StringIO). Проверены: {possible_name_columns}")
-            st.write("Список столбцов в DataFrame (StringIO):")
-            st.write(df.columns.tolist())
-            return None
+def copy_upload(uploaded_file):
+    """Копия загруженного файла с его именем: задача читает её в своём потоке, пока скрипт перезапускается."""
+    buffer = io.BytesIO(uploaded_file.getvalue())
+    buffer.name = uploaded_file.name
+    return buffer
 
-        if name_column != 'Наименование товара':
-            df = df.rename(columns={name_column: 'Наименование товара'})
-            st.write(f"Столбец '{name_column}' переименован в 'Наименование товара' (StringIO)")
 
-        st.write("Файл успешно прочитан с использованием StringIO и кодировки 'cp1251'")
-        st.write("Список столбцов в DataFrame (StringIO):")
-        st.write(df.columns.tolist())
-        return df
+def drop_run():
+    """Забывает результат сессии; его задача, если ещё не завершилась, отменяется и не занимает место в очереди."""
+    run = st.session_state.pop('run', None)
+    if run is not None:
+        cancel_job(get_job_queue(), run['job_id'])
 
-    except Exception as e:
-        st.error(f"Не удалось прочитать CSV файл ни с одной из предложенных кодировок/разделителей. Ошибка: {e}")
-        return None
+
+def show_diagnostics(metrics, context):
+    """Панель диагностики: время, память и объёмы по этапам, выгрузка в JSON Lines."""
+    with st.expander("Диагностика", expanded=True):
+        st.dataframe(metrics)
+        st.download_button(
+            label="Скачать замеры (JSONL)",
+            data=core().metrics_to_jsonl(metrics, **context),
+            file_name=f"ozon_metrics_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jsonl",
+            mime="application/x-ndjson"
+        )
 
 
 def main():
@@ -416,166 +97,196 @@ def main():
     st.set_page_config(layout="wide")
     st.title("Обработка заказов Озон: PDF и CSV")
 
-    fbs_option = st.selectbox("Выберите тип FBS", list(FBS_PREFIXES.keys()))
-    fbs_prefix = FBS_PREFIXES[fbs_option]
+    fbs_choice = st.selectbox("Выберите тип FBS", [AUTO_FBS_OPTION] + list(FBS_PREFIXES.keys()))
+    fbs_option = None if fbs_choice == AUTO_FBS_OPTION else fbs_choice
+
+    pdf_workers = st.sidebar.number_input("Процессов для чтения PDF", min_value=1, max_value=os.cpu_count() or 1,
+                                          value=DEFAULT_PDF_WORKERS, step=1)
+    fast_excel = st.sidebar.checkbox("Быстрая выгрузка Excel", value=True)
+    fast_scan = st.sidebar.checkbox("Быстрый поиск стикеров в PDF", value=True,
+                                    help="Ищет 'FBS: ...' прямо в тексте страницы; если не нашёл — полный разбор текста")
+    incremental = st.sidebar.checkbox(
+        "Только новые страницы", value=False, disabled=DEFAULT_STICKER_INDEX_DIR is None,
+        help="Для накопительного PDF: в результат попадают только страницы, которые ещё не выдавались, и их заказы")
+    if incremental and st.sidebar.button("Начать новую смену"):
+        drop_run()
+        core().reset_page_index(DEFAULT_STICKER_INDEX_DIR)
+        st.sidebar.success("Список выданных страниц очищен")
+    batch_size = st.sidebar.number_input(
+        "Стикеров в пачке PDF", min_value=0, value=0, step=100,
+        help="0 — один PDF. Иначе — ZIP с PDF на каждый диапазон Код листа подбора")
+    low_memory = st.sidebar.checkbox(
+        "Экономия памяти", value=False,
+        help="Для больших выгрузок: читаются только нужные столбцы CSV, таблицы не кэшируются и не копируются")
+    diagnostics = st.sidebar.checkbox("Диагностика по этапам", value=False)
 
     st.header("1. Загрузка файлов")
-    uploaded_csv_file = st.file_uploader("Загрузите CSV файл с заказами", type=["csv", "txt"])
-    uploaded_pdf_file = st.file_uploader("Загрузите PDF файл со стикерами", type="pdf")
-
-    if uploaded_csv_file and uploaded_pdf_file:
+    uploaded_csv_files = st.file_uploader("Загрузите CSV файлы с заказами", type=["csv", "txt"],
+                                          accept_multiple_files=True,
+                                          help="Файлы нескольких волн смены объединяются в один лист подбора")
+    uploaded_pdf_files = st.file_uploader("Загрузите PDF файлы со стикерами", type="pdf", accept_multiple_files=True,
+                                          help="Стикеры нескольких волн смены объединяются в один PDF")
+    # Страница уже показана: пока пользователь выбирает файлы, модуль обработки загружается в фоне.
+    if WARM_UP:
+        start_warm_up()
+
+    if uploaded_csv_files and uploaded_pdf_files:
         st.success("Файлы успешно загружены!")
 
-        try:
-            df_original = read_csv_with_encoding(uploaded_csv_file)
+        # Каждая пара файлов с одними настройками обрабатывается одной фоновой задачей; при перезапусках скрипта
+        # (например, по кнопке скачивания) страница снова опрашивает ту же задачу.
+        # В режиме новых страниц задача уже отметила свои страницы выданными: повторная обработка не нашла бы
+        # новых страниц, поэтому результат привязан только к файлам и складу и сохраняется при смене настроек.
+        input_key = (tuple(f.file_id for f in uploaded_csv_files), tuple(f.file_id for f in uploaded_pdf_files),
+                     fbs_option, incremental)
+        settings = (int(pdf_workers), fast_excel, fast_scan, int(batch_size), low_memory, diagnostics)
+        run_key = input_key if incremental else input_key + settings
+        run = st.session_state.get('run')
+        if run is None or run['key'] != run_key or get_job(get_job_queue(), run['job_id']) is None:
+            drop_run()
+            metrics = []
+            run = {
+                'key': run_key,
+                'settings': settings,
+                'batch_size': int(batch_size),
+                'metrics': metrics,
+                'metrics_context': {
+                    'started_at': datetime.now().isoformat(timespec='seconds'),
+                    'fbs': fbs_choice,
+                    'csv_bytes': sum(f.size for f in uploaded_csv_files),
+                    'pdf_bytes': sum(f.size for f in uploaded_pdf_files),
+                    'pdf_workers': int(pdf_workers),
+                },
+                'logged': False,
+                'job_id': submit_job(get_job_queue(), core().process_orders,
+                                     [copy_upload(f) for f in uploaded_csv_files],
+                                     [copy_upload(f) for f in uploaded_pdf_files], fbs_option,
+                                     workers=int(pdf_workers), fast_excel=fast_excel, cache=get_result_cache(),
+                                     metrics=metrics, trace_memory=diagnostics, fast_scan=fast_scan,
+                                     sticker_index_dir=DEFAULT_STICKER_INDEX_DIR, incremental=incremental,
+                                     batch_size=int(batch_size) or None, low_memory=low_memory),
+            }
+            st.session_state['run'] = run
+
+        if run['settings'] != settings:
+            st.info("Результат новых страниц получен с прежними настройками: страницы уже отмечены выданными, "
+                    "поэтому он не пересчитывается. Новые настройки применятся к следующей выгрузке.")
+        job = get_job(get_job_queue(), run['job_id'])
+        if job['status'] in (JOB_DONE, JOB_FAILED):
+            show_finished_job(run, job, fbs_option, run['batch_size'], diagnostics)
+        else:
+            show_job_progress(run['job_id'])
 
-            if df_original is None:
-                st.stop()
 
-            # st.write(f"Тип данных столбца 'Наименование товара': {df_original['Наименование товара'].dtype}")
-            # st.write(f"Количество NaN в столбце 'Наименование товара': {df_original['Наименование товара'].isnull().sum()}")
-            df_original['Наименование товара'] = df_original['Наименование товара'].astype(str).fillna('')
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def show_job_progress(job_id):
+    """
+    Показывает ход фоновой задачи, опрашивая её раз в JOB_POLL_SECONDS без перезапуска всей страницы.
+    Когда задача завершилась, скрипт перезапускается целиком и показывает результаты.
+    """
+    job = get_job(get_job_queue(), job_id)
+    if job is None or job['status'] in (JOB_DONE, JOB_FAILED, JOB_CANCELLED):
+        st.rerun()
+    if job['status'] == JOB_QUEUED:
+        st.progress(0.0, text=f"Задача в очереди, перед ней задач: {job['position'] - 1}")
+    else:
+        st.progress(job['progress'], text=f"{STAGE_LABELS.get(job['stage'], 'Обработка')}…")
 
-            df_original['Стикер'] = df_original['Номер заказа'].apply(extract_order_number_prefix)
-            df_with_order_prefix = df_original.dropna(subset=['Стикер']).copy()
 
-            if df_with_order_prefix.empty:
-                st.warning(
-                    "Не найдено ни одного номера заказа в формате 'число-' в колонке 'Номер заказа' CSV файла. Проверьте формат номеров заказов.")
+def show_finished_job(run, job, fbs_option, batch_size, diagnostics):
+    """Результаты завершённой задачи: ошибка либо файлы для скачивания."""
+    if job['status'] == JOB_FAILED:
+        e = job['error']
+        if isinstance(e, core().ProcessingError):
+            if e.level == 'warning':
+                st.warning(str(e))
             else:
-                df_sorted_by_shipment_sticker = df_with_order_prefix.copy()
-                df_sorted = sort_dataframe(df_sorted_by_shipment_sticker)
-
-                df_sorted = df_sorted.reset_index(drop=True)
-
-                df_sorted['Номер отправления для отображения'] = df_sorted['Номер отправления']
-                df_sorted['Стикер для отображения'] = df_sorted['Стикер']
-                df_repeats = df_sorted[df_sorted['shipment_sticker_repeated_flag']].copy()
-                df_repeats = df_repeats.sort_values(by=['Номер отправления'])
-                df_sorted = df_sorted[~df_sorted['shipment_sticker_repeated_flag']].copy()
-
-                num_rows = len(df_sorted)
-                df_sorted['Код'] = pd.Series(range(1, num_rows + 1), index=df_sorted.index)
-
-                start_num_repeats = df_sorted['Код'].max() + 1 if not df_sorted.empty else 1
-                num_rows_repeats = len(df_repeats)
-                df_repeats['Код'] = pd.Series(range(start_num_repeats, start_num_repeats + num_rows_repeats),
-                                              index=df_repeats.index)
-
-                df_sorted = df_sorted.rename(columns={'Количество': 'Кол-во'})
-                df_repeats = df_repeats.rename(columns={'Количество': 'Кол-во'})
-
-                desired_columns = ['Код', 'Номер отправления для отображения', 'Наименование товара', 'Артикул',
-                                   'Кол-во', 'Стикер для отображения']
-
-                df_for_excel = df_sorted[desired_columns].copy()
-                df_repeats_for_excel = df_repeats[desired_columns].copy()
-                df_for_excel = df_for_excel.rename(columns={
-                    'Номер отправления для отображения': 'Номер отправления',
-                    'Стикер для отображения': 'Стикер'
-                })
-
-                df_repeats_for_excel = df_repeats_for_excel.rename(columns={
-                    'Номер отправления для отображения': 'Номер отправления',
-                    'Стикер для отображения': 'Стикер'
-                })
-
-                # ==Отладочный вывод DataFrame перед Excel==
-                # st.write("DataFrame основной перед функцией customize_excel:")
-                # st.write(df_for_excel)
-
-                # st.write("DataFrame повторов перед функцией customize_excel:")
-                # st.write(df_repeats_for_excel)
-
-                pdf_sticker_data = extract_sticker_data_from_pdf(uploaded_pdf_file, fbs_prefix)
-
-                reader = PdfReader(uploaded_pdf_file)
-                num_pdf_pages = len(reader.pages)
-
-                if not pdf_sticker_data:
-                    st.warning(
-                        f"Не удалось извлечь ни одного стикера из PDF файла. Проверьте, соответствует ли формат стикера шаблону 'FBS: {fbs_prefix} XXXXX'.")
-                else:
-                    pdf_pages_in_csv_order = []
-                    missing_pdf_pages = []
-
-                    for index, row in df_sorted.iterrows():
-                        csv_identifier = row['Стикер']
-                        found_page = None
-                        for page_num, pdf_sticker_value in pdf_sticker_data.items():
-                            if pdf_sticker_value == csv_identifier:
-                                found_page = (page_num, pdf_sticker_value)
-                                del pdf_sticker_data[page_num]
-                                break
-
-                        if found_page:
-                            pdf_pages_in_csv_order.append(found_page)
-                        else:
-                            missing_pdf_pages.append(csv_identifier)
-
-                    for index, row in df_repeats.iterrows():
-                        csv_identifier = row['Стикер']
-                        found_page = None
-                        for page_num, pdf_sticker_value in pdf_sticker_data.items():
-                            if pdf_sticker_value == csv_identifier:
-                                found_page = (page_num, pdf_sticker_value)
-                                del pdf_sticker_data[page_num]
-                                break
-
-                        if found_page:
-                            pdf_pages_in_csv_order.append(found_page)
-                        else:
-                            missing_pdf_pages.append(csv_identifier)
-
-                    if missing_pdf_pages:
-                        st.warning(
-                            f"Следующие заказы из подбора листа отмечены как соединёнными: {', '.join(missing_pdf_pages)}. Список будет выписан на новый лист (Повторы) в excel файле.")
-                    if pdf_sticker_data:
-                        st.info(
-                            f"Найдены заказы одному клиенту, их номер заказов: {', '.join(pdf_sticker_data.values())}. Эти страницы не будут использованы.")
-
-                    if not pdf_pages_in_csv_order:
-                        st.error(
-                            "Не удалось найти соответствие между идентификаторами из CSV и стикерами из PDF. Переупорядочивание PDF невозможно.")
-                    else:
-                        reordered_pdf_writer = reorder_pdf_pages(uploaded_pdf_file, pdf_pages_in_csv_order)
-
-                        if reordered_pdf_writer:
-                            st.success("Стикеры успешно переупорядочены!")
-
-                            st.header("- Лист подбора(Excel) -")
-
-                            df_for_excel['Стикер'] = df_for_excel['Стикер'].apply(get_last_4_digits)
-                            df_repeats_for_excel['Стикер'] = df_repeats_for_excel['Стикер'].apply(get_last_4_digits)
-
-                            excel_buffer = customize_excel(df_for_excel, df_repeats_for_excel, fbs_option,
-                                                           num_pdf_pages)
-                            # Блок для скачивания Excel
-                            if excel_buffer:
-                                st.download_button(
-                                    label="Скачать отсортированный Excel файл",
-                                    data=excel_buffer.getvalue(),
-                                    file_name=f"Repeats_Ozon_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
-                                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-                                )
-
-                            # Блок для скачивания PDF
-                            pdf_output_buffer = io.BytesIO()
-                            reordered_pdf_writer.write(pdf_output_buffer)
-                            pdf_output_buffer.seek(0)
-                            st.header("- Стикеры(PDF файл) -")
-                            st.write("Ваш новый PDF файл с переупорядоченными страницами:")
-                            st.download_button(
-                                label="Скачать Стикеры",
-                                data=pdf_output_buffer,
-                                file_name=f"Repeats_Ozon-{datetime.now().strftime('%H-%M-%S')}.pdf",
-                                mime="application/pdf"
-                            )
-
-        except Exception as e:
+                st.error(str(e))
+        else:
             st.error(f"Произошла ошибка при обработке файлов: {e}")
             st.exception(e)
 
+    if METRICS_LOG_PATH and not run['logged']:
+        core().append_metrics_log(METRICS_LOG_PATH, run['metrics'], **run['metrics_context'])
+        run['logged'] = True
+    if diagnostics:
+        show_diagnostics(run['metrics'], run['metrics_context'])
+    if job['status'] == JOB_FAILED:
+        return
+    show_result(job['result'], fbs_option, batch_size)
+
+
+def download_data(buffer):
+    """
+    Данные кнопки скачивания: файл читается только по нажатию. Иначе Streamlit при каждом перезапуске скрипта
+    хэшировал бы и держал в памяти все итоговые файлы, а большой PDF лежит во временном файле на диске.
+    """
+    return partial(core().output_bytes, buffer)
+
+
+def show_result(result, fbs_option, batch_size):
+    """Сообщения по итогам обработки и кнопки скачивания PDF и Excel."""
+    csv_format = result['csv_format']
+    st.caption(f"CSV: кодировка {csv_format.get('encoding')}, разделитель {csv_format.get('sep')!r}")
+
+    pdf_sources = result['pdf_sources']
+    if len(pdf_sources) > 1:
+        st.dataframe([{'PDF': source['name'], 'Страниц': source['pages'], 'В результате': source['used'],
+                       'Повторы из предыдущих файлов': source['repeated']} for source in pdf_sources])
+    if result['repeated_shipments']:
+        st.info(f"Отправлений, которые есть в нескольких CSV файлах: {result['repeated_shipments']}. "
+                f"Они взяты из первого файла, где встретились.")
+    if result['new_pages'] is not None:
+        st.info(f"Новых страниц в PDF: {result['new_pages']}")
+
+    warehouses = result['warehouses']
+    if fbs_option is None:
+        st.info(f"Склад определён по стикерам: {result['fbs_option']}")
+    if len(warehouses) > 1:
+        other_warehouses = ', '.join(f"{name} ({count} стр.)" for name, count in warehouses.items()
+                                     if name != result['fbs_option'])
+        st.warning(
+            f"В PDF есть стикеры нескольких складов. Обработаны стикеры склада {result['fbs_option']}, страницы других складов не вошли в результат: {other_warehouses}.")
+
+    missing_pdf_pages = result['missing_pdf_pages']
+    unused_pages = result['unused_pages']
+    if missing_pdf_pages:
+        st.warning(
+            f"Следующие заказы из подбора листа отмечены как соединёнными: {', '.join(missing_pdf_pages)}. Список будет выписан на новый лист (Повторы) в excel файле.")
+    if unused_pages:
+        st.info(
+            f"Найдены заказы одному клиенту, их номер заказов: {', '.join(unused_pages.values())}. Эти страницы не будут использованы.")
+
+    st.success("Стикеры успешно переупорядочены!")
+
+    st.header("- Лист подбора(Excel) -")
+    # Блок для скачивания Excel
+    st.download_button(
+        label="Скачать отсортированный Excel файл",
+        data=download_data(result['excel']),
+        file_name=f"Repeats_Ozon_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
+        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    )
+
+    # Блок для скачивания PDF
+    st.header("- Стикеры(PDF файл) -")
+    if result['pdf_zip'] is not None:
+        st.write(f"Переупорядоченные страницы разбиты на пачки по {batch_size} значений Код листа подбора:")
+        st.download_button(
+            label="Скачать Стикеры (ZIP)",
+            data=download_data(result['pdf_zip']),
+            file_name=f"Repeats_Ozon-{datetime.now().strftime('%H-%M-%S')}.zip",
+            mime="application/zip"
+        )
+    else:
+        st.write("Ваш новый PDF файл с переупорядоченными страницами:")
+        st.download_button(
+            label="Скачать Стикеры",
+            data=download_data(result['pdf']),
+            file_name=f"Repeats_Ozon-{datetime.now().strftime('%H-%M-%S')}.pdf",
+            mime="application/pdf"
+        )
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,367 @@
+"""
+Замеры производительности по этапам обработки на синтетических данных.
+
+Пример:
+    python ozon_bench.py --orders 5000 --save-baseline
+    python ozon_bench.py --orders 5000
+
+Генерируются CSV заказов Озон (с повторами отправлений, k-суффиксами артикулов и количествами)
+и PDF стикеров с текстом 'FBS: <префикс> <номер>'. Для каждого этапа выводятся время, пропускная
+способность и пиковая память; результат сравнивается с сохранённой базовой линией.
+Отдельно замеряется время импорта при холодном старте: страницы Streamlit и модуля обработки.
+Запись PDF замеряется двумя путями — прежним и со слиянием одинаковых объектов (compact) — с размером
+итогового файла; --embed-font встраивает шрифт в каждую страницу, как это делают генераторы этикеток.
+"""
+import argparse
+import io
+import json
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+from collections import Counter
+from pathlib import Path
+
+from pypdf import PdfWriter
+from pypdf.generic import DecodedStreamObject, DictionaryObject, NameObject, NumberObject
+
+import ozon_core
+
+DEFAULT_BASELINE = '.bench_baseline.json'
+
+ARTICLE_SUFFIXES = ['', '', '', 'k2', 'k3', 'k4', 'k5', 'k10', 'a1', 'b2']
+
+# Размер шрифта, встраиваемого в каждую страницу с --embed-font, байт.
+EMBEDDED_FONT_BYTES = 32 * 1024
+
+# С какого числа строк пик памяти пересчитывается на 100 000 строк.
+MIN_ROWS_FOR_PEAK_RATE = 50_000
+
+# Холодный старт: (этап, модуль, что уже загружено до него). Страница ozon.py замеряется после streamlit —
+# его загружает сам `streamlit run`, — а модуль обработки ozon_core отдельно: интерфейс загружает его лениво.
+STARTUP_IMPORTS = [
+    ('startup_ui', 'ozon', 'streamlit'),
+    ('startup_core', 'ozon_core', None),
+]
+
+# Остальные столбцы настоящей выгрузки Озон: обработке они не нужны, но занимают память при чтении.
+EXPORT_EXTRA_COLUMNS = [
+    'Принят в обработку', 'Дата отгрузки', 'Статус', 'Дата доставки', 'Фактическая дата передачи в доставку',
+    'Сумма отправления', 'Код валюты отправления', 'OZON id', 'Ваша цена', 'Код валюты товара',
+    'Оплачено покупателем', 'Код валюты покупателя', 'Стоимость доставки', 'Связанные отправления',
+    'Выкуп товара', 'Цена товара до скидок', 'Скидка %', 'Скидка руб', 'Акции',
+]
+
+
+def generate_orders_csv(num_orders, seed=0, repeat_share=0.15, multi_shipment_share=0.1, sep=';', encoding='utf-8',
+                        full_export=False):
+    """
+    Генерирует CSV выгрузку заказов Озон; full_export добавляет остальные столбцы настоящей выгрузки.
+    Возвращает байты CSV и список стикеров отправлений — по одному на страницу PDF.
+    """
+    rnd = random.Random(seed)
+    num_articles = max(10, num_orders // 5)
+    articles = [f"ART-{i:05d}{rnd.choice(ARTICLE_SUFFIXES)}" for i in range(num_articles)]
+    names = {article: f"Товар {article.split('-')[1][:3]} размер {rnd.randint(40, 56)}" for article in articles}
+
+    header = ['Номер заказа', 'Номер отправления', 'Наименование товара', 'Артикул', 'Количество']
+    if full_export:
+        header += EXPORT_EXTRA_COLUMNS
+    lines = [sep.join(header)]
+    label_stickers = []
+    used_orders = set()
+    while len(used_orders) < num_orders:
+        order = str(rnd.randrange(10_000_000, 99_999_999))
+        if order in used_orders:
+            continue
+        used_orders.add(order)
+        num_shipments = 2 if rnd.random() < multi_shipment_share else 1
+        for shipment_num in range(1, num_shipments + 1):
+            shipment = f"{order}-0001-{shipment_num}"
+            num_items = rnd.randint(2, 3) if rnd.random() < repeat_share else 1
+            for _ in range(num_items):
+                article = rnd.choice(articles)
+                written_article = article.lower() if rnd.random() < 0.3 else article
+                quantity = rnd.choice([1, 1, 1, 1, 2, 3])
+                fields = [f"{order}-0001", shipment, names[article], written_article, str(quantity)]
+                if full_export:
+                    price = rnd.randint(300, 9000)
+                    fields += ['2024-05-14 10:21:03', '2024-05-15 14:00:00', 'Ожидает отгрузки', '', '',
+                               str(price * quantity), 'RUB', str(rnd.randrange(100_000_000, 999_999_999)), str(price),
+                               'RUB', str(price * quantity), 'RUB', '', '', 'нет', str(price + 500), '10',
+                               '500', 'Скидка продавца']
+                lines.append(sep.join(fields))
+            label_stickers.append(order)
+    return ('\n'.join(lines) + '\n').encode(encoding), label_stickers
+
+
+def embedded_font(writer, font_bytes):
+    """Шрифт со своей копией файла шрифта — отдельные объекты на каждую страницу."""
+    font_file = DecodedStreamObject()
+    font_file.set_data(font_bytes)
+    font_file[NameObject('/Length1')] = NumberObject(len(font_bytes))
+    descriptor = DictionaryObject({
+        NameObject('/Type'): NameObject('/FontDescriptor'),
+        NameObject('/FontName'): NameObject('/Helvetica'),
+        NameObject('/FontFile2'): writer._add_object(font_file),
+    })
+    return writer._add_object(DictionaryObject({
+        NameObject('/Type'): NameObject('/Font'),
+        NameObject('/Subtype'): NameObject('/TrueType'),
+        NameObject('/BaseFont'): NameObject('/Helvetica'),
+        NameObject('/FontDescriptor'): writer._add_object(descriptor),
+    }))
+
+
+def generate_labels_pdf(stickers, fbs_prefix, num_pages=None, embed_font=False):
+    """
+    Генерирует PDF стикеров: по странице на стикер с текстом 'FBS: <префикс> <номер>' и номером отправления —
+    k-я страница одного заказа получает отправление '<номер>-0001-k', как в generate_orders_csv.
+    num_pages обрезает или повторяет список стикеров до нужного числа страниц.
+    С embed_font в каждую страницу встраивается своя копия одного и того же шрифта (EMBEDDED_FONT_BYTES).
+    """
+    if num_pages is not None:
+        stickers = [stickers[i % len(stickers)] for i in range(num_pages)]
+    font = DictionaryObject({
+        NameObject('/Type'): NameObject('/Font'),
+        NameObject('/Subtype'): NameObject('/Type1'),
+        NameObject('/BaseFont'): NameObject('/Helvetica'),
+    })
+    font_bytes = random.Random(0).randbytes(EMBEDDED_FONT_BYTES) if embed_font else None
+    writer = PdfWriter()
+    shipment_counts = Counter()
+    for sticker in stickers:
+        shipment_counts[sticker] += 1
+        page = writer.add_blank_page(width=336, height=241)
+        if embed_font:
+            font = embedded_font(writer, font_bytes)
+        page[NameObject('/Resources')] = DictionaryObject({
+            NameObject('/Font'): DictionaryObject({NameObject('/F1'): font}),
+        })
+        content = DecodedStreamObject()
+        content.set_data(
+            f"BT /F1 14 Tf 20 210 Td (OZON) Tj 0 -24 Td (FBS: {fbs_prefix} {sticker}) Tj "
+            f"0 -24 Td ({sticker}-0001-{shipment_counts[sticker]}) Tj ET".encode('ascii'))
+        page.replace_contents(content)
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
+
+
+def measure(stage, units, func, trace_memory):
+    """Выполняет этап и возвращает результат и замер: время, пропускная способность, пиковая память."""
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    result = func()
+    seconds = time.perf_counter() - start
+    peak_mb = None
+    if trace_memory:
+        peak_mb = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        tracemalloc.stop()
+    return result, {
+        'stage': stage,
+        'seconds': seconds,
+        'units': units,
+        'per_second': units / seconds if seconds else None,
+        'peak_mb': peak_mb,
+    }
+
+
+def import_seconds(module, preload=None, repeats=3):
+    """Время импорта модуля в новом процессе интерпретатора, сек: лучшее из repeats запусков."""
+    code = f"import time; start = time.perf_counter(); import {module}; print(time.perf_counter() - start)"
+    if preload:
+        code = f"import {preload}; " + code
+    times = []
+    for _ in range(repeats):
+        completed = subprocess.run([sys.executable, '-c', code], cwd=Path(__file__).resolve().parent,
+                                   capture_output=True, text=True, check=True)
+        times.append(float(completed.stdout.split()[-1]))
+    return min(times)
+
+
+def startup_stats(repeats=3):
+    """Замеры холодного старта по STARTUP_IMPORTS в том же виде, что и замеры этапов."""
+    return [{'stage': stage, 'seconds': import_seconds(module, preload, repeats), 'units': 1, 'per_second': None,
+             'peak_mb': None} for stage, module, preload in STARTUP_IMPORTS]
+
+
+def csv_peak_rss_mb(csv_bytes, low_memory=False):
+    """
+    Прирост пиковой памяти процесса от чтения CSV до готовых таблиц Excel, МБ.
+    tracemalloc не видит строки pyarrow, поэтому пик снимается по RSS: счётчик пика сбрасывается
+    через /proc/self/clear_refs. Вне Linux возвращает None.
+    """
+    base = ozon_core.reset_peak_rss()
+    if base is None:
+        return None
+    df_original = ozon_core.read_csv_with_encoding(io.BytesIO(csv_bytes), low_memory=low_memory)
+    df_with_order_prefix = ozon_core.add_order_stickers(df_original, copy=not low_memory)
+    del df_original
+    df_sorted = ozon_core.sort_dataframe(df_with_order_prefix if low_memory else df_with_order_prefix.copy())
+    del df_with_order_prefix
+    df_sorted, df_repeats = ozon_core.split_repeats(df_sorted)
+    frames = ozon_core.build_excel_frames(df_sorted, df_repeats)
+    del frames, df_sorted, df_repeats
+    return ozon_core.current_rss_mb('VmHWM') - base
+
+
+def run_stages(csv_bytes, pdf_bytes, fbs_option, pdf_workers=1, trace_memory=False, low_memory=False):
+    """Прогоняет этапы конвейера по очереди и возвращает замеры каждого."""
+    fbs_prefix = ozon_core.FBS_PREFIXES[fbs_option]
+    stats = []
+
+    def step(stage, units, func):
+        result, stat = measure(stage, units, func, trace_memory)
+        stats.append(stat)
+        return result
+
+    df_original = step('csv_read', csv_bytes.count(b'\n'),
+                       lambda: ozon_core.read_csv_with_encoding(io.BytesIO(csv_bytes), low_memory=low_memory))
+    num_rows = len(df_original)
+    df_with_order_prefix = ozon_core.add_order_stickers(df_original, copy=not low_memory)
+    df_sorted = step('sort', num_rows, lambda: ozon_core.sort_dataframe(
+        df_with_order_prefix if low_memory else df_with_order_prefix.copy()))
+    df_sorted, df_repeats = ozon_core.split_repeats(df_sorted)
+
+    pdf_document = step('pdf_open', 1, lambda: ozon_core.open_pdf_document(io.BytesIO(pdf_bytes)))
+    num_pages = pdf_document['num_pages']
+    stickers_by_prefix = step('pdf_extract', num_pages,
+                              lambda: ozon_core.extract_sticker_data_from_pdf(pdf_document, workers=pdf_workers))
+    sticker_data = stickers_by_prefix.get(fbs_prefix, {})
+    page_order, _, _, _ = step('match', num_rows,
+                            lambda: ozon_core.match_stickers_to_pages(df_sorted, df_repeats, sticker_data))
+
+    def write_pdf(document, compact):
+        buffer = io.BytesIO()
+        ozon_core.reorder_pdf_pages(document, page_order, compact).write(buffer)
+        return buffer
+
+    # Каждый путь записи получает документ в том же состоянии, что и в process_orders, — после извлечения стикеров:
+    # иначе второй путь пользовался бы объектами, уже разобранными первым.
+    for stage, compact in (('pdf_write', False), ('pdf_compact', True)):
+        if compact:
+            pdf_document = ozon_core.open_pdf_document(io.BytesIO(pdf_bytes))
+            ozon_core.extract_sticker_data_from_pdf(pdf_document, workers=pdf_workers)
+        buffer = step(stage, len(page_order), lambda: write_pdf(pdf_document, compact))
+        stats[-1]['bytes'] = buffer.getbuffer().nbytes
+        ozon_core.close_pdf_document(pdf_document)
+
+    df_for_excel, df_repeats_for_excel = ozon_core.build_excel_frames(df_sorted, df_repeats)
+    step('excel_fast', num_rows, lambda: ozon_core.customize_excel(
+        df_for_excel, df_repeats_for_excel, fbs_option, num_pages, fast=True))
+    step('excel_openpyxl', num_rows, lambda: ozon_core.customize_excel(
+        df_for_excel, df_repeats_for_excel, fbs_option, num_pages, fast=False))
+    return stats
+
+
+def run_benchmark(orders, pages=None, seed=0, fbs_option='Озон', pdf_workers=1, trace_memory=True,
+                  full_export=False, low_memory=False, startup=True, embed_font=False):
+    """
+    Генерирует данные и замеряет этапы; время и память снимаются в отдельных прогонах.
+    С startup первыми в замерах идут времена импорта при холодном старте (см. STARTUP_IMPORTS).
+    """
+    csv_bytes, stickers = generate_orders_csv(orders, seed=seed, full_export=full_export)
+    csv_rows = csv_bytes.count(b'\n') - 1
+    # Пик по RSS снимается первым, пока память процесса не занята прогонами этапов.
+    csv_peak = csv_peak_rss_mb(csv_bytes, low_memory) if trace_memory else None
+    pdf_bytes = generate_labels_pdf(stickers, ozon_core.FBS_PREFIXES[fbs_option], num_pages=pages,
+                                    embed_font=embed_font)
+    stats = run_stages(csv_bytes, pdf_bytes, fbs_option, pdf_workers, low_memory=low_memory)
+    if trace_memory:
+        memory_stats = run_stages(csv_bytes, pdf_bytes, fbs_option, pdf_workers, trace_memory=True,
+                                  low_memory=low_memory)
+        for stat, memory_stat in zip(stats, memory_stats):
+            stat['peak_mb'] = memory_stat['peak_mb']
+    if startup:
+        stats = startup_stats() + stats
+    return {
+        'params': {'orders': orders, 'pages': pages, 'seed': seed, 'fbs': fbs_option, 'pdf_workers': pdf_workers,
+                   'full_export': full_export, 'low_memory': low_memory, 'embed_font': embed_font},
+        'csv_mb': len(csv_bytes) / 2 ** 20,
+        'csv_rows': csv_rows,
+        'csv_peak_rss_mb': csv_peak,
+        'pdf_mb': len(pdf_bytes) / 2 ** 20,
+        'stages': stats,
+    }
+
+
+def format_report(report, baseline=None):
+    """Таблица замеров; при наличии базовой линии — с отношением времени к ней."""
+    baseline_seconds = {}
+    if baseline is not None:
+        baseline_seconds = {stat['stage']: stat['seconds'] for stat in baseline['stages']}
+    lines = [
+        f"Параметры: {report['params']}, CSV {report['csv_mb']:.1f} МБ, PDF {report['pdf_mb']:.1f} МБ",
+        f"{'этап':<16}{'сек':>10}{'ед./сек':>12}{'пик, МБ':>10}{'к базе':>10}",
+    ]
+    for stat in report['stages']:
+        per_second = f"{stat['per_second']:.0f}" if stat['per_second'] else '-'
+        peak = f"{stat['peak_mb']:.1f}" if stat['peak_mb'] is not None else '-'
+        ratio = '-'
+        if baseline_seconds.get(stat['stage']):
+            ratio = f"{stat['seconds'] / baseline_seconds[stat['stage']]:.2f}x"
+        lines.append(f"{stat['stage']:<16}{stat['seconds']:>10.3f}{per_second:>12}{peak:>10}{ratio:>10}")
+    written = {stat['stage']: stat['bytes'] for stat in report['stages'] if stat.get('bytes') is not None}
+    if 'pdf_write' in written and 'pdf_compact' in written:
+        lines.append(f"Итоговый PDF: {written['pdf_write'] / 2 ** 20:.2f} МБ, "
+                     f"compact — {written['pdf_compact'] / 2 ** 20:.2f} МБ")
+    if report.get('csv_peak_rss_mb') is not None:
+        line = f"Пик памяти от CSV до таблиц Excel: {report['csv_peak_rss_mb']:.0f} МБ"
+        # На малых объёмах пик определяют постоянные расходы, и пересчёт на 100 000 строк его завышает.
+        if report['csv_rows'] >= MIN_ROWS_FOR_PEAK_RATE:
+            per_100k = report['csv_peak_rss_mb'] * 100_000 / report['csv_rows']
+            line += (f", {per_100k:.0f} МБ на 100 000 строк "
+                     f"(цель режима low_memory — {ozon_core.LOW_MEMORY_PEAK_MB_PER_100K_ROWS} МБ)")
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Замеры этапов обработки заказов Озон на синтетических данных.")
+    parser.add_argument('--orders', type=int, default=2000, help="Число заказов в CSV")
+    parser.add_argument('--pages', type=int, default=None, help="Число страниц PDF (по умолчанию — по числу отправлений)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--fbs', choices=list(ozon_core.FBS_PREFIXES.keys()), default='Озон')
+    parser.add_argument('--pdf-workers', type=int, default=1)
+    parser.add_argument('--full-export', action='store_true',
+                        help="Все столбцы настоящей выгрузки Озон, а не только нужные обработке")
+    parser.add_argument('--low-memory', action='store_true', help="Режим low_memory: только нужные столбцы, без копий")
+    parser.add_argument('--embed-font', action='store_true',
+                        help="Встроить в каждую страницу PDF свою копию шрифта, как в настоящих этикетках")
+    parser.add_argument('--no-memory', action='store_true', help="Не замерять пиковую память (вдвое быстрее)")
+    parser.add_argument('--no-startup', action='store_true', help="Не замерять время импорта при холодном старте")
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help="Файл базовой линии")
+    parser.add_argument('--save-baseline', action='store_true', help="Сохранить результат как базовую линию")
+    parser.add_argument('--json', action='store_true', help="Вывести результат в JSON")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = run_benchmark(args.orders, args.pages, args.seed, args.fbs, args.pdf_workers,
+                           trace_memory=not args.no_memory, full_export=args.full_export, low_memory=args.low_memory,
+                           startup=not args.no_startup, embed_font=args.embed_font)
+
+    baseline_path = Path(args.baseline)
+    baseline = None
+    if baseline_path.exists() and not args.save_baseline:
+        baseline = json.loads(baseline_path.read_text(encoding='utf-8'))
+        if baseline.get('params') != report['params']:
+            print(f"Базовая линия снята с другими параметрами: {baseline.get('params')}", file=sys.stderr)
+
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print(format_report(report, baseline))
+
+    if args.save_baseline:
+        baseline_path.write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding='utf-8')
+        print(f"Базовая линия сохранена: {baseline_path}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
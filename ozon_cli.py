@@ -0,0 +1,226 @@
+"""
+Обработка заказов Озон из командной строки, без браузера.
+
+Пример:
+    python ozon_cli.py --out-dir out --pair orders1.csv labels1.pdf --pair orders2.csv labels2.pdf
+    python ozon_cli.py --out-dir out --csv wave1.csv wave2.csv --pdf wave1.pdf wave2.pdf
+
+Для каждой пары CSV/PDF записываются переупорядоченный PDF стикеров и Excel лист подбора.
+Файлы нескольких волн смены (--csv и --pdf) объединяются в один лист подбора и один PDF.
+Без --fbs склад определяется по стикерам в PDF.
+Несколько пар обрабатываются параллельно в пуле процессов.
+"""
+import argparse
+import os
+import sys
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from datetime import datetime
+from pathlib import Path
+
+from ozon_config import DEFAULT_STICKER_INDEX_DIR, FBS_PREFIXES
+from ozon_core import ProcessingError, append_metrics_log, process_orders, reset_page_index, save_output
+
+
+def output_stem(pdf_path):
+    """Основа имени итоговых файлов — имя PDF со стикерами (для нескольких PDF — первого)."""
+    if isinstance(pdf_path, (list, tuple)):
+        pdf_path = pdf_path[0]
+    return Path(pdf_path).stem
+
+
+def output_stems(pdf_paths):
+    """
+    Основы имён итоговых файлов для всех пар. Если имена PDF из разных каталогов совпадают (без учёта регистра,
+    как в файловой системе Windows), к основе добавляется номер пары, чтобы пары не перезаписывали файлы друг друга.
+    """
+    stems = [output_stem(pdf_path) for pdf_path in pdf_paths]
+    counts = Counter(stem.casefold() for stem in stems)
+    return [f"{stem}_{pair_num}" if counts[stem.casefold()] > 1 else stem
+            for pair_num, stem in enumerate(stems, start=1)]
+
+
+def output_paths(out_dir, stem, batches=False):
+    """Пути итоговых PDF и Excel по основе имени; пачки PDF записываются в ZIP."""
+    return Path(out_dir) / f"{stem}_sorted.{'zip' if batches else 'pdf'}", Path(out_dir) / f"{stem}_sorted.xlsx"
+
+
+def process_pair(csv_path, pdf_path, fbs_option, out_dir, pdf_workers=1, fast_excel=True, metrics=None,
+                 fast_scan=True, sticker_index_dir=None, incremental=False, batch_size=None, low_memory=False,
+                 compact_pdf=True, stem=None):
+    """
+    Обрабатывает одну пару файлов (или списки файлов волн одной смены) и возвращает сообщения для вывода.
+    stem — основа имён итоговых файлов; по умолчанию — имя PDF.
+    """
+    messages = []
+    with ExitStack() as stack:
+        csv_file = open_inputs(stack, csv_path)
+        pdf_file = open_inputs(stack, pdf_path)
+        result = process_orders(csv_file, pdf_file, fbs_option, workers=pdf_workers, fast_excel=fast_excel,
+                                metrics=metrics, fast_scan=fast_scan, sticker_index_dir=sticker_index_dir,
+                                incremental=incremental, batch_size=batch_size, low_memory=low_memory,
+                                compact_pdf=compact_pdf)
+
+    if len(result['pdf_sources']) > 1:
+        for source in result['pdf_sources']:
+            messages.append(f"{source['name']}: страниц {source['pages']}, в результате {source['used']}"
+                            + (f", повторов из предыдущих файлов {source['repeated']}" if source['repeated'] else ""))
+    if result['repeated_shipments']:
+        messages.append(f"Отправлений, повторяющихся в нескольких CSV (взяты из первого файла): "
+                        f"{result['repeated_shipments']}")
+    if result['new_pages'] is not None:
+        messages.append(f"Новых страниц в PDF: {result['new_pages']}")
+    warehouses = result['warehouses']
+    messages.append(f"Склад: {result['fbs_option']}")
+    if len(warehouses) > 1:
+        messages.append(f"В PDF есть стикеры нескольких складов: "
+                        f"{', '.join(f'{name} ({count} стр.)' for name, count in warehouses.items())}")
+
+    pdf_out, excel_out = output_paths(out_dir, stem or output_stem(pdf_path), batches=bool(batch_size))
+    save_output(result['pdf_zip'] if batch_size else result['pdf'], pdf_out)
+    save_output(result['excel'], excel_out)
+
+    if result['missing_pdf_pages']:
+        messages.append(f"Соединённые заказы (лист Повторы): {', '.join(result['missing_pdf_pages'])}")
+    if result['unused_pages']:
+        messages.append(f"Неиспользованные страницы: "
+                        f"{', '.join(format_page(page_num, result['pdf_sources']) for page_num in result['unused_pages'])}")
+    messages.append(f"Записано: {pdf_out}, {excel_out}")
+    return messages
+
+
+def open_inputs(stack, paths):
+    """Открывает файл или список файлов для чтения; файлы закрываются вместе со stack."""
+    if isinstance(paths, (list, tuple)):
+        return [stack.enter_context(open(path, 'rb')) for path in paths]
+    return stack.enter_context(open(paths, 'rb'))
+
+
+def format_page(page_num, pdf_sources):
+    """Номер страницы для вывода; при нескольких PDF — с именем файла и номером страницы в нём."""
+    if len(pdf_sources) < 2:
+        return str(page_num)
+    for source in pdf_sources:
+        if page_num <= source['pages']:
+            return f"{source['name']} стр. {page_num}"
+        page_num -= source['pages']
+    return str(page_num)
+
+
+def input_bytes(paths):
+    """Общий размер входного файла или списка файлов, байт."""
+    if isinstance(paths, (list, tuple)):
+        return sum(Path(path).stat().st_size for path in paths)
+    return Path(paths).stat().st_size
+
+
+def input_names(paths):
+    """Файл или список файлов для вывода."""
+    if isinstance(paths, (list, tuple)):
+        return ', '.join(map(str, paths))
+    return str(paths)
+
+
+def process_pair_with_metrics(csv_path, pdf_path, fbs_option, out_dir, pdf_workers=1, fast_excel=True,
+                              fast_scan=True, sticker_index_dir=None, incremental=False, batch_size=None,
+                              low_memory=False, compact_pdf=True, stem=None):
+    """Обрабатывает пару в рабочем процессе и возвращает сообщения, замеры этапов и ошибку, если была."""
+    metrics = []
+    try:
+        messages = process_pair(csv_path, pdf_path, fbs_option, out_dir, pdf_workers, fast_excel, metrics, fast_scan,
+                                sticker_index_dir, incremental, batch_size, low_memory, compact_pdf, stem)
+        return messages, metrics, None
+    except Exception as e:
+        return [], metrics, e
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Сортировка заказов Озон: CSV и PDF стикеров без Streamlit.")
+    parser.add_argument('--pair', nargs=2, action='append', metavar=('CSV', 'PDF'),
+                        help="CSV файл заказов и PDF файл стикеров; можно указать несколько раз")
+    parser.add_argument('--csv', nargs='+', metavar='CSV',
+                        help="CSV файлы волн одной смены — объединяются в один лист подбора (вместе с --pdf)")
+    parser.add_argument('--pdf', nargs='+', metavar='PDF',
+                        help="PDF файлы стикеров волн одной смены — объединяются в один PDF (вместе с --csv)")
+    parser.add_argument('--fbs', choices=list(FBS_PREFIXES.keys()),
+                        help="Склад FBS; по умолчанию определяется по стикерам в PDF")
+    parser.add_argument('--out-dir', default='.', help="Каталог для итоговых файлов")
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1,
+                        help="Сколько пар обрабатывать одновременно")
+    parser.add_argument('--pdf-workers', type=int, default=1,
+                        help="Процессов для чтения одного PDF (используется, только если обрабатывается одна пара за раз)")
+    parser.add_argument('--excel-engine', choices=['xlsxwriter', 'openpyxl'], default='xlsxwriter',
+                        help="xlsxwriter — быстрая потоковая выгрузка, openpyxl — прежняя")
+    parser.add_argument('--full-text-scan', action='store_true',
+                        help="Искать стикер только полным извлечением текста страницы (медленнее)")
+    parser.add_argument('--sticker-index', default=DEFAULT_STICKER_INDEX_DIR,
+                        help="Каталог индекса стикеров уже обработанных PDF (по умолчанию %(default)s)")
+    parser.add_argument('--no-sticker-index', action='store_true', help="Не использовать индекс стикеров")
+    parser.add_argument('--incremental', action='store_true',
+                        help="Выдавать только страницы накопительного PDF, которые ещё не выдавались, и их заказы")
+    parser.add_argument('--reset-seen-pages', action='store_true',
+                        help="Перед обработкой забыть выданные страницы (начало новой смены)")
+    parser.add_argument('--batch-size', type=int, default=None,
+                        help="Записать стикеры в ZIP пачками по столько значений Код листа подбора")
+    parser.add_argument('--low-memory', action='store_true',
+                        help="Читать из CSV только нужные столбцы и не держать промежуточные копии таблиц")
+    parser.add_argument('--no-compact-pdf', action='store_true',
+                        help="Не сливать одинаковые шрифты и изображения страниц в итоговом PDF (прежняя запись)")
+    parser.add_argument('--metrics-log', help="Файл JSON Lines, в который дописываются замеры этапов")
+    args = parser.parse_args(argv)
+    if bool(args.csv) != bool(args.pdf):
+        parser.error("--csv и --pdf указываются вместе")
+    if not args.pair and not args.csv:
+        parser.error("укажите --pair или --csv и --pdf")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    Path(args.out_dir).mkdir(parents=True, exist_ok=True)
+    fast_excel = args.excel_engine == 'xlsxwriter'
+    pairs = list(args.pair or [])
+    if args.csv:
+        pairs.append((args.csv, args.pdf))
+    jobs = max(1, min(args.jobs, len(pairs)))
+    if args.incremental:
+        # Пары делят один индекс страниц, поэтому обрабатываются по очереди.
+        jobs = 1
+    # Вложенные пулы процессов не запускаем: при нескольких парах каждый PDF читается одним процессом.
+    pdf_workers = args.pdf_workers if jobs == 1 else 1
+    sticker_index_dir = None if args.no_sticker_index else args.sticker_index
+    if args.reset_seen_pages and sticker_index_dir is not None:
+        reset_page_index(sticker_index_dir)
+
+    stems = output_stems([pdf_path for _, pdf_path in pairs])
+
+    failed = 0
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [
+            (csv_path, pdf_path,
+             executor.submit(process_pair_with_metrics, csv_path, pdf_path, args.fbs, args.out_dir, pdf_workers,
+                             fast_excel, not args.full_text_scan, sticker_index_dir, args.incremental,
+                             args.batch_size, args.low_memory, not args.no_compact_pdf, stem))
+            for (csv_path, pdf_path), stem in zip(pairs, stems)
+        ]
+        for csv_path, pdf_path, future in futures:
+            print(f"== {input_names(csv_path)} + {input_names(pdf_path)}")
+            messages, metrics, error = future.result()
+            for message in messages:
+                print(message)
+            if isinstance(error, ProcessingError):
+                failed += 1
+                print(f"{'Предупреждение' if error.level == 'warning' else 'Ошибка'}: {error}", file=sys.stderr)
+            elif error is not None:
+                failed += 1
+                print(f"Ошибка при обработке файлов: {error}", file=sys.stderr)
+            if args.metrics_log:
+                append_metrics_log(args.metrics_log, metrics, started_at=datetime.now().isoformat(timespec='seconds'),
+                                   fbs=args.fbs or 'auto', csv=input_names(csv_path), pdf=input_names(pdf_path),
+                                   csv_bytes=input_bytes(csv_path), pdf_bytes=input_bytes(pdf_path))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,26 @@
+"""
+Настройки, которые нужны интерфейсу до загрузки файлов.
+
+Модуль не импортирует pandas, pypdf и openpyxl: страница Streamlit показывается
+сразу, а модуль обработки ozon_core загружается только когда файлы загружены
+(или заранее, в фоновом прогреве).
+"""
+import os
+
+FBS_PREFIXES = {
+    "Озон": "204514",
+    "Рига": "2503733",
+    "Плутон": "3021812"
+}
+
+DEFAULT_PDF_WORKERS = min(4, os.cpu_count() or 1)
+
+# Предел памяти для кэша результатов, общего для всех сессий.
+RESULT_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+# Каталог дискового индекса стикеров; пустая переменная окружения OZON_STICKER_INDEX_DIR отключает индекс.
+DEFAULT_STICKER_INDEX_DIR = os.environ.get(
+    "OZON_STICKER_INDEX_DIR", os.path.join(os.path.expanduser("~"), ".cache", "ozon_stickers")) or None
+
+# Прогревать ли модуль обработки в фоне после первого показа страницы; OZON_WARM_UP=0 отключает прогрев.
+WARM_UP = os.environ.get("OZON_WARM_UP", "1") != "0"
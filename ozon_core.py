@@ -0,0 +1,1486 @@
+"""
+Обработка заказов Озон без интерфейса: чтение CSV, сортировка, стикеры из PDF, сопоставление, PDF и Excel.
+Используется приложением Streamlit (ozon.py) и командной строкой (ozon_cli.py).
+"""
+import pandas as pd
+import numpy as np
+import re
+import io
+import os
+import codecs
+import sys
+import hashlib
+import json
+import shutil
+import tempfile
+import threading
+import time
+import tracemalloc
+import zipfile
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from functools import lru_cache
+from pathlib import Path
+from pypdf import PdfReader, PdfWriter
+from datetime import datetime
+from openpyxl.styles import Font, Alignment
+from openpyxl.utils import get_column_letter
+import xlsxwriter
+
+# Настройки лежат в лёгком модуле ozon_config, чтобы интерфейс показывал страницу без загрузки этого модуля.
+from ozon_config import FBS_PREFIXES
+from ozon_workers import (compact_pdf_writer, effective_workers, extract_stickers_parallel, find_sticker_on_page,
+                          sticker_pattern, write_batches_parallel)
+
+# Объём начала CSV файла, по которому определяются кодировка и разделитель.
+CSV_SAMPLE_BYTES = 64 * 1024
+
+# Размер части, которой файл с диска читается при подсчёте хэша: файл целиком в память не загружается.
+HASH_CHUNK_BYTES = 1024 * 1024
+
+# Итоговые PDF и ZIP до этого размера держатся в памяти, больше — во временном файле на диске.
+OUTPUT_SPOOL_BYTES = 32 * 1024 * 1024
+
+# Этапы обработки в порядке выполнения — по ним считается доля выполненной работы.
+PIPELINE_STAGES = ['csv_read', 'sort', 'pdf_open', 'pdf_extract', 'delta', 'match', 'excel', 'pdf_write']
+
+# Как часто сообщать о ходе извлечения стикеров при последовательном чтении, страниц.
+PROGRESS_PAGE_STEP = 25
+
+# Столбцы CSV, которые использует обработка (кроме столбца наименования, у которого два возможных названия).
+CSV_COLUMNS = ['Номер заказа', 'Номер отправления', 'Артикул', 'Количество']
+
+# Цель по пиковому приросту памяти процесса в режиме low_memory на 100 000 строк полной выгрузки Озон
+# (24 столбца, ~23 МБ CSV) от чтения CSV до готовых таблиц Excel. Замер: ~92 МБ, без режима — ~150 МБ.
+# Около половины — память, которую придерживает пул mimalloc pyarrow; с ARROW_DEFAULT_MEMORY_POOL=system
+# пик ~46 МБ. Проверка: python ozon_bench.py --orders 75000 --full-export --low-memory
+LOW_MEMORY_PEAK_MB_PER_100K_ROWS = 100
+
+# Предел размера дискового индекса стикеров; при превышении удаляются давно не использованные записи.
+STICKER_INDEX_MAX_BYTES = 64 * 1024 * 1024
+
+# Версия формата записей индекса: записи другой версии не читаются.
+STICKER_INDEX_VERSION = 1
+
+# Индекс страниц накопительных PDF: файл в подкаталоге индекса стикеров и предел числа страниц в нём.
+# Подкаталог не попадает под вытеснение записей индекса стикеров и не учитывается в их размере.
+PAGE_INDEX_DIR = 'pages'
+PAGE_INDEX_FILE = 'index.json'
+PAGE_INDEX_MAX_PAGES = 200_000
+PAGE_INDEX_VERSION = 2
+PAGE_INDEX_LOCK = threading.Lock()
+
+# tracemalloc один на процесс, а задачи выполняются в потоках одного процесса: этапы с замером выделений Python
+# идут по одному, иначе одна задача сбрасывает или останавливает трассировку посреди этапа другой.
+TRACE_MEMORY_LOCK = threading.Lock()
+
+DESIRED_COLUMNS = ['Код', 'Номер отправления для отображения', 'Наименование товара', 'Артикул',
+                   'Кол-во', 'Стикер для отображения']
+
+
+class ProcessingError(Exception):
+    """Ошибка обработки, которую нужно показать пользователю; level — 'error' или 'warning'."""
+
+    def __init__(self, message, level='error'):
+        super().__init__(message)
+        self.level = level
+
+    def __reduce__(self):
+        return ProcessingError, (str(self), self.level)
+
+
+def extract_order_number_prefixes(order_numbers):
+    """Извлекает префиксы номеров заказов (цифры до первого '-') сразу для всего столбца; без префикса — NaN."""
+    return order_numbers.astype(str).str.extract(r'^(\d+)-', expand=False)
+
+
+def extract_stickers_from_orders(order_numbers):
+    """Извлекает стикеры (4 цифры перед '-') из номеров заказов сразу для всего столбца; без стикера — NaN."""
+    return order_numbers.astype(str).str.extract(r'(\d{4})-', expand=False)
+
+
+def factorize_lower(values):
+    """
+    Кодирует строки без учёта регистра целыми числами в порядке сортировки.
+    lower() выполняется только для уникальных значений; возвращает коды строк и уникальные значения.
+    """
+    raw_codes, raw_uniques = pd.factorize(values.astype(str), use_na_sentinel=False)
+    lower_codes, lower_uniques = pd.factorize(pd.Series(raw_uniques).str.lower(), sort=True, use_na_sentinel=False)
+    return lower_codes[raw_codes], pd.Series(lower_uniques)
+
+
+def code_counts(codes, size):
+    """Для каждой строки — сколько раз встречается её код."""
+    return np.bincount(codes, minlength=size)[codes]
+
+
+def pair_counts(left_codes, right_codes, right_size):
+    """Считает повторения пары кодов без склейки строк."""
+    pair_codes, _ = pd.factorize(left_codes.astype(np.int64) * right_size + right_codes)
+    return np.bincount(pair_codes)[pair_codes]
+
+
+def sort_dataframe(df):
+    """
+    Сортирует DataFrame в соответствии с заданными приоритетами.
+    Ключи считаются векторно на целочисленных кодах; регулярные выражения применяются только к уникальным артикулам.
+    """
+    required_cols = ['Артикул', 'Количество', 'Наименование товара', 'Номер отправления', 'Стикер']
+    for col in required_cols:
+        if col not in df.columns:
+            df[col] = ''
+
+    df['Количество'] = pd.to_numeric(df['Количество'], errors='coerce').fillna(0)
+    df['Артикул'] = df['Артикул'].astype(str)
+
+    article_codes, articles = factorize_lower(df['Артикул'])
+    name_codes, _ = factorize_lower(df['Наименование товара'])
+    shipment_codes, _ = pd.factorize(df['Номер отправления'].astype(str), use_na_sentinel=False)
+    sticker_codes, stickers = pd.factorize(df['Стикер'].astype(str), use_na_sentinel=False)
+
+    # Основная часть артикула — без суффикса вида 'k3' / 'a12' в конце.
+    article_cores = articles.str.replace(r'[a-z]\d+$', '', n=1, regex=True).str.strip()
+    core_codes_by_article, cores = pd.factorize(article_cores, sort=True, use_na_sentinel=False)
+    core_codes = core_codes_by_article[article_codes]
+
+    core_repeat_count = code_counts(core_codes, len(cores))
+    full_sticker_repeat_count = code_counts(article_codes, len(articles))
+    shipment_sticker_repeated_flag = pair_counts(shipment_codes, sticker_codes, len(stickers)) > 1
+    name_article_repeated = pair_counts(name_codes, article_codes, len(articles))
+
+    has_k_prefix_num = articles.str.contains(r'.*[k][2-5]\d*.*', na=False).to_numpy(dtype=bool)[article_codes]
+    k_match = articles.str.extract(r'.*[k]([2-6]\d*)$', expand=False)
+    k_num_suffix = pd.to_numeric(k_match, errors='coerce').fillna(0).to_numpy(dtype=float)[article_codes]
+    quantity = df['Количество'].to_numpy(dtype=float)
+    qty_greater_than_1 = quantity > 1
+    article_repeated = full_sticker_repeat_count > 1
+
+    sort_level = np.select(
+        [(core_repeat_count > 1) & has_k_prefix_num,
+         article_repeated & qty_greater_than_1,
+         article_repeated],
+        [1, 2, 3],
+        default=4
+    )
+
+    # np.lexsort сортирует устойчиво, главный ключ — последний. Убывание — через отрицание.
+    order = np.lexsort((
+        article_codes,  # 'Артикул' (в нижнем регистре): по возрастанию
+        name_codes,  # 'Наименование товара' (в нижнем регистре): по возрастанию
+        -core_repeat_count,  # Число повторений основной части артикула: по убыванию
+        -quantity,  # 'Количество': по убыванию
+        core_codes,  # Основная часть артикула: по возрастанию
+        sort_level,  # Остальные критерии: по возрастанию
+        -name_article_repeated,  # Приоритет 5: Повторение "Наименование товара" и "Артикул" (убывание)
+        ~article_repeated,  # Приоритет 4: Сначала повторяющийся артикул
+        ~qty_greater_than_1,  # Приоритет 3: Сначала Количество > 1
+        -k_num_suffix,  # Номер после k/K: по убыванию
+        ~has_k_prefix_num,  # Приоритет 2: Сначала артикулы с k/K и числом
+        ~shipment_sticker_repeated_flag,  # Приоритет 1: Сначала повторяющиеся "Номер отправления" и "Стикер"
+    ))
+
+    df['shipment_sticker_repeated_flag'] = shipment_sticker_repeated_flag
+    return df.iloc[order]
+
+
+def file_display_name(uploaded_file, index):
+    """Имя файла для сообщений: имя загруженного или открытого файла, иначе его номер в списке."""
+    name = getattr(uploaded_file, 'name', None)
+    return Path(name).name if isinstance(name, str) else f"файл {index + 1}"
+
+
+def open_pdf_document(pdf_files):
+    """
+    Разбирает PDF один раз.
+    Документ хранит файлы с их читателями, индекс страниц и карту стикеров; его используют извлечение,
+    подсчёт страниц и переупорядочивание. Несколько PDF (список файлов) объединяются в один документ:
+    страницы нумеруются подряд в порядке файлов, а в 'sources' для каждого файла записана его первая страница.
+    """
+    if not isinstance(pdf_files, (list, tuple)):
+        pdf_files = [pdf_files]
+    sources = []
+    pages = {}
+    for index, pdf_file in enumerate(pdf_files):
+        name = file_display_name(pdf_file, index)
+        try:
+            pdf_file.seek(0)
+            reader = PdfReader(pdf_file)
+            first_page = len(pages) + 1
+            for i, page in enumerate(reader.pages):
+                pages[first_page + i] = page
+        except Exception as e:
+            raise ProcessingError(f"Ошибка при чтении PDF файла {name}: {e}" if len(pdf_files) > 1 else
+                                  f"Ошибка при чтении PDF файла: {e}") from e
+        sources.append({'name': name, 'file': pdf_file, 'reader': reader, 'first_page': first_page,
+                        'num_pages': len(reader.pages)})
+    return {
+        'sources': sources,
+        'pages': pages,
+        'num_pages': len(pages),
+        'stickers': None,
+    }
+
+
+def pdf_worker_sources(pdf_document):
+    """
+    Файлы документа для рабочих процессов, которые открывают PDF заново: для файла на диске — путь
+    (процесс отображает файл в память, и копии файла в памяти нет ни у него, ни у основного процесса),
+    для файла в памяти — его байты без копирования (getvalue() у BytesIO копию не создаёт).
+    """
+    worker_sources = []
+    for source in pdf_document['sources']:
+        pdf_file = source['file']
+        try:
+            pdf_file.fileno()
+            on_disk = isinstance(pdf_file.name, str)
+        except (AttributeError, OSError):
+            on_disk = False
+        if on_disk:
+            worker_sources.append(pdf_file.name)
+        elif hasattr(pdf_file, 'getvalue'):
+            worker_sources.append(pdf_file.getvalue())
+        else:
+            pdf_file.seek(0)
+            worker_sources.append(pdf_file.read())
+    return worker_sources
+
+
+def page_source(pdf_document, page_num):
+    """Файл документа (элемент 'sources'), которому принадлежит страница со сквозным номером page_num."""
+    sources = pdf_document['sources']
+    return sources[bisect_right([source['first_page'] for source in sources], page_num) - 1]
+
+
+def page_origin(pdf_document, page_num):
+    """Имя файла и номер страницы в нём по сквозному номеру страницы документа."""
+    source = page_source(pdf_document, page_num)
+    return source['name'], page_num - source['first_page'] + 1
+
+
+def close_pdf_document(pdf_document):
+    """Освобождает разобранный PDF после записи итогового файла."""
+    pdf_document.clear()
+
+
+def new_output_buffer():
+    """Буфер итогового файла: в памяти до OUTPUT_SPOOL_BYTES, дальше — временный файл, удаляемый при закрытии."""
+    return tempfile.SpooledTemporaryFile(max_size=OUTPUT_SPOOL_BYTES)
+
+
+def output_bytes(buffer):
+    """Содержимое итогового файла целиком — для кнопки скачивания; у BytesIO — без копирования."""
+    if hasattr(buffer, 'getvalue'):
+        return buffer.getvalue()
+    buffer.seek(0)
+    return buffer.read()
+
+
+def save_output(buffer, path):
+    """Записывает итоговый файл на диск частями, не собирая его содержимое в памяти."""
+    buffer.seek(0)
+    with open(path, 'wb') as output_file:
+        shutil.copyfileobj(buffer, output_file)
+    buffer.seek(0)
+
+
+def extract_page_stickers(pdf_document, page_numbers=None, fbs_prefixes=None, workers=1, fast_scan=True,
+                          page_progress=None):
+    """
+    Извлекает стикеры со страниц PDF (по умолчанию — со всех) за один проход сразу по всем префиксам складов.
+    Возвращает {страница: (префикс, номер)}.
+    При workers > 1 страницы делятся между процессами; результат тот же, что и при последовательном чтении.
+    При fast_scan номер ищется сначала в текстовых операторах страницы и только потом полным extract_text().
+    page_progress(готово, всего) сообщает, сколько страниц уже прочитано.
+    """
+    if page_numbers is None:
+        page_numbers = list(pdf_document['pages'])
+    if fbs_prefixes is None:
+        fbs_prefixes = FBS_PREFIXES.values()
+    fbs_prefixes = tuple(fbs_prefixes)
+    page_stickers = {}
+    try:
+        workers = effective_workers(len(page_numbers), workers)
+        if workers > 1:
+            page_stickers = extract_stickers_parallel(pdf_worker_sources(pdf_document), fbs_prefixes, page_numbers, workers, fast_scan,
+                                                      page_progress)
+        else:
+            for done, page_num in enumerate(page_numbers, start=1):
+                sticker = find_sticker_on_page(pdf_document['pages'][page_num], fbs_prefixes, fast_scan)
+                if sticker:
+                    page_stickers[page_num] = sticker
+                if page_progress is not None and (done % PROGRESS_PAGE_STEP == 0 or done == len(page_numbers)):
+                    page_progress(done, len(page_numbers))
+    except Exception as e:
+        raise ProcessingError(f"Ошибка при обработке PDF файла: {e}") from e
+    return page_stickers
+
+
+def group_stickers_by_prefix(page_stickers):
+    """Раскладывает {страница: (префикс, номер)} в карты стикеров по префиксам: {префикс: {страница: номер}}."""
+    stickers_by_prefix = {}
+    for page_num, (prefix, sticker_number) in page_stickers.items():
+        stickers_by_prefix.setdefault(prefix, {})[page_num] = sticker_number
+    return stickers_by_prefix
+
+
+def extract_sticker_data_from_pdf(pdf_document, fbs_prefixes=None, workers=1, fast_scan=True, page_progress=None):
+    """
+    Извлекает данные стикеров из PDF.
+    Возвращает карты стикеров по префиксам: {префикс: {страница: номер}}; в PDF с несколькими складами карт несколько.
+    """
+    stickers_by_prefix = group_stickers_by_prefix(
+        extract_page_stickers(pdf_document, fbs_prefixes=fbs_prefixes, workers=workers, fast_scan=fast_scan,
+                              page_progress=page_progress))
+    pdf_document['stickers'] = stickers_by_prefix
+    return {prefix: dict(sticker_data) for prefix, sticker_data in stickers_by_prefix.items()}
+
+
+def drop_repeated_sticker_pages(pdf_document, stickers_by_prefix):
+    """
+    Убирает из карт стикеров страницы, которые с тем же содержимым (см. page_content_hash) уже встретились
+    в одном из предыдущих файлов документа: выгрузки волн одной смены могут повторять этикетки.
+    Внутри одного файла страницы не сравниваются. Возвращает карты стикеров и сквозные номера убранных страниц.
+    """
+    if len(pdf_document['sources']) < 2:
+        return stickers_by_prefix, []
+    sticker_pages = sorted(page_num for sticker_data in stickers_by_prefix.values() for page_num in sticker_data)
+    seen_hashes = set()
+    repeated_pages = set()
+    for source in pdf_document['sources']:
+        last_page = source['first_page'] + source['num_pages']
+        source_pages = sticker_pages[bisect_left(sticker_pages, source['first_page']):
+                                     bisect_left(sticker_pages, last_page)]
+        source_hashes = set()
+        for page_num in source_pages:
+            page_hash = page_content_hash(pdf_document['pages'][page_num])
+            if page_hash in seen_hashes:
+                repeated_pages.add(page_num)
+            source_hashes.add(page_hash)
+        seen_hashes |= source_hashes
+    if not repeated_pages:
+        return stickers_by_prefix, []
+    kept = {}
+    for prefix, sticker_data in stickers_by_prefix.items():
+        prefix_data = {page_num: number for page_num, number in sticker_data.items() if page_num not in repeated_pages}
+        if prefix_data:
+            kept[prefix] = prefix_data
+    return kept, sorted(repeated_pages)
+
+
+def summarize_pdf_sources(pdf_document, page_order_mapping, repeated_pages):
+    """По каждому PDF документа: имя, число страниц, сколько из них вошло в результат и сколько убрано как повторы."""
+    summary = [{'name': source['name'], 'pages': source['num_pages'], 'used': 0, 'repeated': 0}
+               for source in pdf_document['sources']]
+    first_pages = [source['first_page'] for source in pdf_document['sources']]
+    for page_num, _ in page_order_mapping:
+        summary[bisect_right(first_pages, page_num) - 1]['used'] += 1
+    for page_num in repeated_pages:
+        summary[bisect_right(first_pages, page_num) - 1]['repeated'] += 1
+    return summary
+
+
+def detect_warehouses(stickers_by_prefix):
+    """Склады, стикеры которых найдены в PDF: {склад: число страниц}, от большего числа страниц к меньшему."""
+    found = {name: len(stickers_by_prefix[prefix]) for name, prefix in FBS_PREFIXES.items()
+             if stickers_by_prefix.get(prefix)}
+    return dict(sorted(found.items(), key=lambda item: item[1], reverse=True))
+
+
+def reorder_pdf_pages(pdf_document, page_order_mapping, compact=False):
+    """
+    Переупорядочивает страницы PDF.
+    С compact одинаковые объекты страниц (шрифты, логотипы, встроенные в каждую этикетку отдельно) сливаются
+    в один, а объекты, на которые ничего не ссылается, не записываются (см. compact_pdf_writer).
+    """
+    pages_dict = pdf_document['pages']
+    for original_page_num, _ in page_order_mapping:
+        if original_page_num not in pages_dict:
+            raise ProcessingError(f"Страница {original_page_num} из PDF не найдена. Проверьте соответствие стикеров.")
+    try:
+        writer = PdfWriter()
+        for original_page_num, _ in page_order_mapping:
+            page_to_add = pages_dict[original_page_num]
+            writer.add_page(page_to_add)
+        if compact:
+            compact_pdf_writer(writer)
+        return writer
+    except Exception as e:
+        raise ProcessingError(f"Ошибка при переупорядочивании страниц PDF: {e}") from e
+
+
+def split_print_batches(page_order_mapping, page_codes, batch_size):
+    """
+    Делит страницы в порядке листа подбора на пачки по диапазонам Код: 1..batch_size, batch_size+1..2*batch_size и т.д.
+    Возвращает список (первый Код, последний Код, страницы); диапазоны без страниц пропускаются.
+    """
+    batches = {}
+    for (original_page_num, _), code in zip(page_order_mapping, page_codes):
+        batches.setdefault((code - 1) // batch_size, []).append(original_page_num)
+    last_code = max(page_codes, default=0)
+    return [(i * batch_size + 1, min((i + 1) * batch_size, last_code), pages) for i, pages in sorted(batches.items())]
+
+
+def write_pdf_batches_zip(pdf_document, page_order_mapping, page_codes, batch_size, workers=1, compact=False):
+    """
+    Записывает переупорядоченные страницы пачками — отдельный PDF на каждый диапазон Код — и упаковывает их в ZIP.
+    При workers > 1 пачки пишутся параллельно в пуле процессов; compact — как в reorder_pdf_pages.
+    """
+    pages_dict = pdf_document['pages']
+    for original_page_num, _ in page_order_mapping:
+        if original_page_num not in pages_dict:
+            raise ProcessingError(f"Страница {original_page_num} из PDF не найдена. Проверьте соответствие стикеров.")
+    batches = split_print_batches(page_order_mapping, page_codes, batch_size)
+
+    def sequential_batch_pdfs():
+        for _, _, pages in batches:
+            buffer = io.BytesIO()
+            reorder_pdf_pages(pdf_document, [(page_num, None) for page_num in pages], compact).write(buffer)
+            yield buffer.getvalue()
+
+    width = max(4, len(str(max(page_codes, default=0))))
+    zip_buffer = new_output_buffer()
+    # Каждая пачка попадает в ZIP сразу, как только записана: в памяти не держатся все пачки разом.
+    try:
+        workers = min(effective_workers(len(page_order_mapping), workers), len(batches))
+        if workers > 1:
+            batch_pdfs = write_batches_parallel(pdf_worker_sources(pdf_document), [pages for _, _, pages in batches],
+                                                workers, compact)
+        else:
+            batch_pdfs = sequential_batch_pdfs()
+        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+            for (first_code, last_code, _), batch_pdf in zip(batches, batch_pdfs):
+                zip_file.writestr(f"Коды_{first_code:0{width}d}-{last_code:0{width}d}.pdf", batch_pdf)
+    except ProcessingError:
+        zip_buffer.close()
+        raise
+    except Exception as e:
+        zip_buffer.close()
+        raise ProcessingError(f"Ошибка при записи пачек PDF: {e}") from e
+    zip_buffer.seek(0)
+    return zip_buffer
+
+
+def match_stickers_to_pages(df_sorted, df_repeats, pdf_sticker_data):
+    """
+    Сопоставляет строки CSV со страницами PDF по стикеру.
+    Каждая строка забирает первую свободную страницу со своим стикером — k-я строка со стикером
+    получает k-ю такую страницу. Возвращает страницы в порядке CSV, ненайденные стикеры, неиспользованные страницы
+    и Код строки Excel для каждой страницы из первого списка.
+    """
+    rows = pd.DataFrame({'sticker': pd.concat([df_sorted['Стикер'], df_repeats['Стикер']], ignore_index=True),
+                         'code': pd.concat([df_sorted['Код'], df_repeats['Код']], ignore_index=True)})
+    rows['occurrence'] = rows.groupby('sticker', sort=False).cumcount()
+
+    pages = pd.DataFrame({'page': list(pdf_sticker_data.keys()), 'sticker': list(pdf_sticker_data.values())})
+    pages['occurrence'] = pages.groupby('sticker', sort=False).cumcount()
+
+    matched = rows.merge(pages, on=['sticker', 'occurrence'], how='left')
+    found_mask = matched['page'].notna()
+    pdf_pages_in_csv_order = list(zip(matched.loc[found_mask, 'page'].astype(int).tolist(),
+                                      matched.loc[found_mask, 'sticker'].tolist()))
+    missing_pdf_pages = matched.loc[~found_mask, 'sticker'].tolist()
+    page_codes = matched.loc[found_mask, 'code'].astype(int).tolist()
+
+    rows_per_sticker = pages['sticker'].map(rows['sticker'].value_counts()).fillna(0)
+    unused = pages[pages['occurrence'] >= rows_per_sticker]
+    unused_pages = dict(zip(unused['page'].tolist(), unused['sticker'].tolist()))
+
+    return pdf_pages_in_csv_order, missing_pdf_pages, unused_pages, page_codes
+
+
+def match_page_shipments(df_sorted, df_repeats, pdf_pages_in_csv_order, page_codes):
+    """Номер отправления строки, которой досталась страница, для каждой сопоставленной страницы (без пустых)."""
+    codes = pd.concat([df_sorted['Код'], df_repeats['Код']], ignore_index=True).astype(int)
+    shipments = pd.concat([df_sorted['Номер отправления'], df_repeats['Номер отправления']],
+                          ignore_index=True).fillna('').astype(str)
+    shipments_by_code = dict(zip(codes.tolist(), shipments.tolist()))
+    return {page_num: shipments_by_code[code] for (page_num, _), code in zip(pdf_pages_in_csv_order, page_codes)
+            if shipments_by_code[code]}
+
+
+@lru_cache(maxsize=None)
+def non_digit_pattern():
+    """Шаблон для всего, что не цифра в смысле str.isdigit(): кроме \\d это ещё, например, надстрочные цифры."""
+    digits = ''.join(chr(code) for code in range(sys.maxunicode + 1) if chr(code).isdigit())
+    return '[^' + re.escape(digits) + ']+'
+
+
+def get_last_4_digits(values):
+    """
+    Последние 4 цифры каждого значения столбца; для пропусков и значений, где цифр меньше четырёх, — пустая строка.
+    Если значение не оканчивается четырьмя цифрами, берутся последние 4 из всех его цифр.
+    """
+    digits = values.astype(str).str.replace(non_digit_pattern(), '', regex=True)
+    return digits.str[-4:].where(values.notna() & (digits.str.len() >= 4), '')
+
+
+def blank_repeated_stickers(df_repeats):
+    """Оставляет стикер только в первой строке каждого повторяющегося заказа."""
+    df_repeats_processed = df_repeats.copy()
+    stickers = df_repeats_processed['Стикер']
+    df_repeats_processed['Стикер'] = stickers.where(~stickers.duplicated(), '')
+    return df_repeats_processed
+
+
+def excel_column_widths(df):
+    """Считает ширину столбцов по данным DataFrame — так же, как по значениям ячеек листа."""
+    widths = []
+    for col in df.columns:
+        values = df[col]
+        lengths = values[values.notna()].astype(str).str.len()
+        max_length = int(lengths.max()) if not lengths.empty else 0
+        widths.append(max(max_length, len(str(col))) + 2)
+    return widths
+
+
+def write_sheet_fast(workbook, sheet_name, df, title_lines, formats):
+    """Записывает лист построчно: форматы задаются на столбцы, жирным выделяется только Кол-во > 1."""
+    sheet = workbook.add_worksheet(sheet_name)
+
+    # === Настройки печати ===
+    sheet.set_landscape()
+    sheet.set_paper(9)
+    sheet.set_margins(left=0, right=0, top=0, bottom=0)
+    sheet.set_header('', {'margin': 0})
+    sheet.set_footer('', {'margin': 0})
+    sheet.set_zoom(100)
+    sheet.freeze_panes(6, 0)
+
+    for col_num, width in enumerate(excel_column_widths(df)):
+        sheet.set_column(col_num, col_num, width, formats['data'])
+
+    # === Заголовки и инфо ===
+    for row_num, (text, title_format) in enumerate(title_lines):
+        sheet.write_string(row_num, 1, text, title_format)
+    sheet.write_row(5, 0, [str(col) for col in df.columns], formats['header'])
+
+    qty_col = df.columns.get_loc('Кол-во') if 'Кол-во' in df.columns else None
+    if qty_col is not None and pd.api.types.is_numeric_dtype(df['Кол-во']):
+        bold_rows = (df['Кол-во'] > 1).tolist()
+    else:
+        bold_rows = [False] * len(df)
+
+    rows = df.astype(object).where(df.notna(), None).itertuples(index=False, name=None)
+    for offset, values in enumerate(rows):
+        row_num = 6 + offset
+        sheet.write_row(row_num, 0, values)
+        if bold_rows[offset]:
+            sheet.write_number(row_num, qty_col, values[qty_col], formats['qty'])
+
+
+def customize_excel_fast(df, df_repeats, fbs_option, num_pdf_pages):
+    """Быстрая выгрузка Excel через xlsxwriter: строки пишутся потоком, без стилизации каждой ячейки."""
+    try:
+        excel_buffer = io.BytesIO()
+        workbook = xlsxwriter.Workbook(excel_buffer, {'constant_memory': True, 'strings_to_urls': False})
+        formats = {
+            'title': workbook.add_format({'bold': True, 'font_size': 16}),
+            'info': workbook.add_format({'bold': True, 'font_size': 13}),
+            'header': workbook.add_format({'bold': True, 'align': 'center'}),
+            'data': workbook.add_format({'align': 'left'}),
+            'qty': workbook.add_format({'bold': True, 'align': 'left'}),
+        }
+        date_line = 'Дата: ' + datetime.now().strftime("%Y-%m-%d %H:%M")
+
+        write_sheet_fast(workbook, 'Лист подбора', df, [
+            ('Лист подбора OZON', formats['title']),
+            (f'Склад: {fbs_option}', formats['info']),
+            (date_line, formats['info']),
+            (f'Количество отправлений: {num_pdf_pages}', formats['info']),
+        ], formats)
+
+        if not df_repeats.empty:
+            write_sheet_fast(workbook, 'Повторы', blank_repeated_stickers(df_repeats), [
+                ('Повторяющиеся заказы', formats['title']),
+                (f'Склад: {fbs_option}', formats['info']),
+                (date_line, formats['info']),
+            ], formats)
+
+        workbook.close()
+        excel_buffer.seek(0)
+        return excel_buffer
+
+    except Exception as e:
+        raise ProcessingError(f"Произошла ошибка при быстрой выгрузке Excel файла: {e}") from e
+
+
+def customize_excel(df, df_repeats, fbs_option, num_pdf_pages, fast=False):
+    """Настраивает Excel файл."""
+    if fast:
+        return customize_excel_fast(df, df_repeats, fbs_option, num_pdf_pages)
+    try:
+        excel_buffer = io.BytesIO()
+        with pd.ExcelWriter(excel_buffer, engine='openpyxl') as writer:
+            # === Лист 1: Основной ===
+            sheet_name_main = 'Лист подбора'
+            df.to_excel(writer, sheet_name=sheet_name_main, index=False, startrow=5)
+            sheet_main = writer.sheets[sheet_name_main]
+
+            # === Заголовки и инфо для основного листа ===
+            sheet_main['B1'] = f'Лист подбора OZON'
+            sheet_main['B1'].font = Font(bold=True, size=16)
+
+            sheet_main['B2'] = f'Склад: {fbs_option}'
+            sheet_main['B2'].font = Font(bold=True, size=13)
+
+            sheet_main['B3'] = 'Дата: ' + datetime.now().strftime("%Y-%m-%d %H:%M")
+            sheet_main['B3'].font = Font(bold=True, size=13)
+
+            sheet_main['B4'] = f'Количество отправлений: {num_pdf_pages}'
+            sheet_main['B4'].font = Font(bold=True, size=13)
+
+            # === Настройки печати для основного листа ===
+            sheet_main.page_setup.orientation = 'landscape'
+            sheet_main.page_setup.paperSize = 9
+            sheet_main.page_margins.left = 0
+            sheet_main.page_margins.right = 0
+            sheet_main.page_margins.top = 0
+            sheet_main.page_margins.bottom = 0
+            sheet_main.page_margins.header = 0
+            sheet_main.page_margins.footer = 0
+
+            sheet_main.sheet_view.fitToPage = True
+            sheet_main.sheet_view.zoomScale = 100
+            sheet_main.sheet_view.zoomToFit = True
+
+            # === Лист 2: Повторы ===
+            if not df_repeats.empty:
+                repeats_sheet_name = 'Повторы'
+
+                df_repeats_processed = blank_repeated_stickers(df_repeats)
+
+                df_repeats_processed.to_excel(writer, sheet_name=repeats_sheet_name, index=False, startrow=5)
+                sheet_repeats = writer.sheets[repeats_sheet_name]
+
+                # === Заголовки и инфо для листа повторов ===
+                sheet_repeats['B1'] = f'Повторяющиеся заказы'
+                sheet_repeats['B1'].font = Font(bold=True, size=16)
+
+                sheet_repeats['B2'] = f'Склад: {fbs_option}'
+                sheet_repeats['B2'].font = Font(bold=True, size=13)
+
+                sheet_repeats['B3'] = 'Дата: ' + datetime.now().strftime("%Y-%m-%d %H:%M")
+                sheet_repeats['B3'].font = Font(bold=True, size=13)
+
+                # === Настройки печати для листа повторов ===
+                sheet_repeats.page_setup.orientation = 'landscape'
+                sheet_repeats.page_setup.paperSize = 9
+                sheet_repeats.page_margins.left = 0
+                sheet_repeats.page_margins.right = 0
+                sheet_repeats.page_margins.top = 0
+                sheet_repeats.page_margins.bottom = 0
+                sheet_repeats.page_margins.header = 0
+                sheet_repeats.page_margins.footer = 0
+
+                sheet_repeats.sheet_view.fitToPage = True
+                sheet_repeats.sheet_view.zoomScale = 100
+                sheet_repeats.sheet_view.zoomToFit = True
+
+                # === Стилизация листа повторов ===
+                header_font = Font(bold=True)
+                header_alignment = Alignment(horizontal='center')
+                data_alignment = Alignment(horizontal='left')
+
+                for col_num in range(1, df_repeats_processed.shape[1] + 1):
+                    cell = sheet_repeats.cell(row=6, column=col_num)
+                    cell.font = header_font
+                    cell.alignment = header_alignment
+
+                for row_num in range(7, sheet_repeats.max_row + 1):
+                    for col_num in range(1, df_repeats_processed.shape[1] + 1):
+                        cell = sheet_repeats.cell(row=row_num, column=col_num)
+                        cell.alignment = data_alignment
+                        if sheet_repeats.cell(row=6, column=col_num).value == 'Кол-во':
+                            if isinstance(cell.value, (int, float)) and cell.value > 1:
+                                cell.font = Font(bold=True)
+
+                for col_num in range(1, df_repeats_processed.shape[1] + 1):
+                    column_letter = get_column_letter(col_num)
+                    max_length = 0
+                    for row_num in range(6, sheet_repeats.max_row + 1):
+                        cell = sheet_repeats[column_letter + str(row_num)]
+                        if cell.value is not None:
+                            max_length = max(max_length, len(str(cell.value)))
+                    header_cell = sheet_repeats[column_letter + '6']
+                    if header_cell.value is not None:
+                        max_length = max(max_length, len(str(header_cell.value)))
+                    sheet_repeats.column_dimensions[column_letter].width = max_length + 2
+
+                # === Заморозка области для листа повторов ===
+                sheet_repeats.freeze_panes = 'A7'
+
+            # === Стилизация основного листа ===
+            header_font = Font(bold=True)
+            header_alignment = Alignment(horizontal='center')
+            data_alignment = Alignment(horizontal='left')
+
+            for col_num in range(1, df.shape[1] + 1):
+                cell = sheet_main.cell(row=6, column=col_num)
+                cell.font = header_font
+                cell.alignment = header_alignment
+
+            for row_num in range(7, sheet_main.max_row + 1):
+                for col_num in range(1, df.shape[1] + 1):
+                    cell = sheet_main.cell(row=row_num, column=col_num)
+                    cell.alignment = data_alignment
+
+                    if sheet_main.cell(row=6, column=col_num).value == 'Кол-во':
+                        if isinstance(cell.value, (int, float)) and cell.value > 1:
+                            cell.font = Font(bold=True)
+
+            for col_num in range(1, df.shape[1] + 1):
+                column_letter = get_column_letter(col_num)
+                max_length = 0
+                for row_num in range(6, sheet_main.max_row + 1):
+                    cell = sheet_main[column_letter + str(row_num)]
+                    if cell.value is not None:
+                        max_length = max(max_length, len(str(cell.value)))
+                header_cell = sheet_main[column_letter + '6']
+                if header_cell.value is not None:
+                    max_length = max(max_length, len(str(header_cell.value)))
+
+                sheet_main.column_dimensions[column_letter].width = max_length + 2
+
+            # === Заморозка области для основного листа ===
+            sheet_main.freeze_panes = 'A7'
+
+        excel_buffer.seek(0)
+        return excel_buffer
+
+    except Exception as e:
+        raise ProcessingError(f"Произошла ошибка при настройке Excel файла: {e}") from e
+
+
+def detect_csv_format(sample):
+    """
+    Определяет кодировку и разделитель CSV по первым байтам файла.
+    Кодировки проверяются в порядке utf-8, cp1251, latin1; разделитель — тот, что чаще встречается в строке заголовков.
+    """
+    if sample.startswith(codecs.BOM_UTF8):
+        encoding = 'utf-8-sig'
+    else:
+        encoding = 'latin1'
+        for candidate in ('utf-8', 'cp1251'):
+            try:
+                codecs.getincrementaldecoder(candidate)().decode(sample, final=False)
+                encoding = candidate
+                break
+            except UnicodeDecodeError:
+                pass
+
+    text = codecs.getincrementaldecoder(encoding)(errors='ignore').decode(sample, final=False)
+    header_line = text.splitlines()[0] if text else ''
+    sep = max([';', ',', '\t'], key=header_line.count)
+    return encoding, sep
+
+
+def read_csv_with_encoding(uploaded_csv_file, low_memory=False):
+    """
+    Читает CSV файл за один проход и определяет столбец 'Наименование товара'.
+    Кодировка и разделитель определяются по началу файла и сохраняются в df.attrs['csv_format'].
+    В режиме low_memory читаются только столбцы, нужные для обработки.
+    """
+    possible_name_columns = ['Наименование товара', 'Название товара']
+    read_options = {}
+    if low_memory:
+        needed_columns = set(CSV_COLUMNS + possible_name_columns)
+        read_options['usecols'] = lambda column: column in needed_columns
+
+    try:
+        uploaded_csv_file.seek(0)
+        encoding, sep = detect_csv_format(uploaded_csv_file.read(CSV_SAMPLE_BYTES))
+        uploaded_csv_file.seek(0)
+        try:
+            df = pd.read_csv(uploaded_csv_file, sep=sep, encoding=encoding, **read_options)
+        except UnicodeDecodeError:
+            # Начало файла оказалось в utf-8, а дальше встретились байты другой кодировки.
+            encoding = 'cp1251'
+            uploaded_csv_file.seek(0)
+            df = pd.read_csv(uploaded_csv_file, sep=sep, encoding=encoding, **read_options)
+    except Exception as e:
+        raise ProcessingError(f"Не удалось прочитать CSV файл. Ошибка: {e}") from e
+
+    name_column = None
+    for col in possible_name_columns:
+        if col in df.columns:
+            name_column = col
+            break
+
+    if name_column is None:
+        raise ProcessingError(f"Не найден столбец с наименованием товара. Проверены: {possible_name_columns}. "
+                              f"Столбцы файла: {df.columns.tolist()}")
+
+    if name_column != 'Наименование товара':
+        df = df.rename(columns={name_column: 'Наименование товара'})
+
+    df.attrs['csv_format'] = {'encoding': encoding, 'sep': sep}
+    return df
+
+
+def read_csv_files(csv_files, low_memory=False, workers=1):
+    """
+    Читает CSV файлы одной смены (при workers > 1 — параллельно в потоках) и объединяет их в одну таблицу.
+    Отправление, которое уже встретилось в одном из предыдущих файлов, из следующих файлов не берётся;
+    число таких отправлений записывается в df.attrs['repeated_shipments']. Строки без номера отправления
+    (например, из файла без столбца 'Номер отправления') берутся все, как и при одном файле.
+    Формат CSV берётся из первого файла.
+    """
+    if len(csv_files) == 1:
+        df = read_csv_with_encoding(csv_files[0], low_memory=low_memory)
+        df.attrs['repeated_shipments'] = 0
+        return df
+
+    def read_file(index):
+        try:
+            return read_csv_with_encoding(csv_files[index], low_memory=low_memory)
+        except ProcessingError as e:
+            raise ProcessingError(f"{file_display_name(csv_files[index], index)}: {e}", level=e.level) from e
+
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(csv_files)))) as executor:
+        frames = list(executor.map(read_file, range(len(csv_files))))
+    csv_format = frames[0].attrs['csv_format']
+
+    source = np.repeat(np.arange(len(frames)), [len(frame) for frame in frames])
+    df = pd.concat(frames, ignore_index=True)
+    del frames
+    repeated_shipments = 0
+    if 'Номер отправления' in df.columns:
+        has_shipment = df['Номер отправления'].notna().to_numpy()
+        shipment_codes, shipments = pd.factorize(df['Номер отправления'].astype(str), use_na_sentinel=False)
+        first_source = np.full(len(shipments), len(csv_files))
+        np.minimum.at(first_source, shipment_codes, source)
+        keep = (source == first_source[shipment_codes]) | ~has_shipment
+        repeated_shipments = len(np.unique(shipment_codes[~keep]))
+        if not keep.all():
+            df = df[keep].reset_index(drop=True)
+
+    df.attrs['csv_format'] = csv_format
+    df.attrs['repeated_shipments'] = repeated_shipments
+    return df
+
+
+def file_content_hash(uploaded_file):
+    """Считает хэш содержимого загруженного файла; файл с диска читается частями по HASH_CHUNK_BYTES."""
+    if hasattr(uploaded_file, 'getbuffer'):
+        with uploaded_file.getbuffer() as buffer:
+            return hashlib.blake2b(buffer, digest_size=20).hexdigest()
+    digest = hashlib.blake2b(digest_size=20)
+    chunk = bytearray(HASH_CHUNK_BYTES)
+    with memoryview(chunk) as view:
+        uploaded_file.seek(0)
+        while size := uploaded_file.readinto(chunk):
+            digest.update(view[:size])
+    uploaded_file.seek(0)
+    return digest.hexdigest()
+
+
+def combined_content_hash(file_hashes):
+    """Хэш набора файлов по хэшам их содержимого; для одного файла — его собственный хэш."""
+    if len(file_hashes) == 1:
+        return file_hashes[0]
+    return hashlib.blake2b(' '.join(file_hashes).encode('ascii'), digest_size=20).hexdigest()
+
+
+def new_result_cache(max_bytes):
+    """Создаёт пустой LRU-кэш результатов с ограничением по памяти."""
+    return {'entries': OrderedDict(), 'size': 0, 'max_bytes': max_bytes, 'lock': threading.Lock()}
+
+
+def estimate_result_size(value):
+    """Оценивает объём памяти, занимаемый результатом."""
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True).sum())
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in value.items())
+    return sys.getsizeof(value)
+
+
+def copy_result(value):
+    """Возвращает копию результата, чтобы изменения вызывающего кода не портили кэш."""
+    if isinstance(value, pd.DataFrame):
+        return value.copy()
+    if isinstance(value, dict):
+        return dict(value)
+    return value
+
+
+def cached_result(cache, key, compute):
+    """
+    Возвращает результат из кэша по ключу или вычисляет и сохраняет его.
+    Ключ строится из хэшей содержимого файлов. None не кэшируется, чтобы ошибки повторялись при следующем запуске.
+    Без кэша (cache=None) результат просто вычисляется.
+    """
+    if cache is None:
+        return compute()
+
+    with cache['lock']:
+        entry = cache['entries'].get(key)
+        if entry is not None:
+            cache['entries'].move_to_end(key)
+            return copy_result(entry[0])
+
+    value = compute()
+    if value is None:
+        return None
+
+    size = estimate_result_size(value)
+    if size <= cache['max_bytes']:
+        with cache['lock']:
+            if key in cache['entries']:
+                cache['size'] -= cache['entries'].pop(key)[1]
+            cache['entries'][key] = (value, size)
+            cache['size'] += size
+            while cache['size'] > cache['max_bytes']:
+                _, (_, evicted_size) = cache['entries'].popitem(last=False)
+                cache['size'] -= evicted_size
+    return copy_result(value)
+
+
+def sticker_index_path(index_dir, pdf_hash):
+    """Файл записи дискового индекса для PDF с данным хэшем содержимого."""
+    return Path(index_dir) / f"{pdf_hash}.json"
+
+
+def load_sticker_index(index_dir, pdf_hash, fast_scan=True):
+    """
+    Читает из дискового индекса число страниц и карты стикеров по префиксам.
+    Возвращает None, если записи нет, она повреждена или снята с другим набором префиксов.
+    Без fast_scan подходят только записи, снятые полным извлечением текста: иначе снятие галочки быстрого поиска
+    не исправило бы однажды неверно прочитанный стикер.
+    """
+    path = sticker_index_path(index_dir, pdf_hash)
+    try:
+        entry = json.loads(path.read_text(encoding='utf-8'))
+        if entry.get('version') != STICKER_INDEX_VERSION or entry.get('prefixes') != sorted(FBS_PREFIXES.values()):
+            return None
+        if not fast_scan and entry.get('fast_scan', True):
+            return None
+        stickers_by_prefix = {prefix: {int(page): number for page, number in sticker_data.items()}
+                              for prefix, sticker_data in entry['stickers'].items()}
+        # Время изменения отмечает последнее использование записи — по нему идёт вытеснение.
+        os.utime(path)
+        return entry['num_pages'], stickers_by_prefix
+    except (OSError, ValueError, KeyError, AttributeError):
+        return None
+
+
+def save_sticker_index(index_dir, pdf_hash, num_pages, stickers_by_prefix, fast_scan=True,
+                       max_bytes=STICKER_INDEX_MAX_BYTES):
+    """
+    Сохраняет карты стикеров PDF в дисковый индекс и вытесняет старые записи сверх max_bytes.
+    fast_scan отмечает, каким поиском сняты стикеры (см. load_sticker_index).
+    Запись пишется во временный файл и переименовывается, поэтому параллельные процессы не видят её недописанной.
+    Ошибки записи не мешают обработке: индекс только ускоряет повторные загрузки.
+    """
+    path = sticker_index_path(index_dir, pdf_hash)
+    entry = {
+        'version': STICKER_INDEX_VERSION,
+        'prefixes': sorted(FBS_PREFIXES.values()),
+        'num_pages': num_pages,
+        'fast_scan': fast_scan,
+        'stickers': stickers_by_prefix,
+    }
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp_path.write_text(json.dumps(entry, ensure_ascii=False), encoding='utf-8')
+        os.replace(tmp_path, path)
+        evict_sticker_index(index_dir, max_bytes)
+    except OSError:
+        pass
+
+
+def evict_sticker_index(index_dir, max_bytes):
+    """Удаляет давно не использованные записи индекса, пока общий размер больше max_bytes."""
+    entries = []
+    for path in Path(index_dir).glob('*.json'):
+        try:
+            stat = path.stat()
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    entries.sort()
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, path in entries:
+        if total_size <= max_bytes:
+            break
+        try:
+            path.unlink()
+        except OSError:
+            continue
+        total_size -= size
+
+
+def indexed_sticker_data(pdf_document, pdf_hashes, index_dir, workers=1, fast_scan=True, page_progress=None):
+    """
+    Карты стикеров по префиксам: для каждого файла документа (pdf_hashes — хэши файлов по порядку) — из дискового
+    индекса, а если файла там нет — извлечением текста с записью в индекс. Страницы всех файлов, которых нет
+    в индексе, читаются за один проход. Без каталога индекса (index_dir=None) стикеры просто извлекаются.
+    """
+    if index_dir is None:
+        return extract_sticker_data_from_pdf(pdf_document, workers=workers, fast_scan=fast_scan,
+                                             page_progress=page_progress)
+
+    page_stickers = {}
+    unindexed = []
+    for source, pdf_hash in zip(pdf_document['sources'], pdf_hashes):
+        indexed = load_sticker_index(index_dir, pdf_hash, fast_scan)
+        if indexed is not None and indexed[0] == source['num_pages']:
+            for prefix, sticker_data in indexed[1].items():
+                for page_num, sticker_number in sticker_data.items():
+                    page_stickers[source['first_page'] + page_num - 1] = (prefix, sticker_number)
+        else:
+            unindexed.append((source, pdf_hash))
+
+    page_numbers = [source['first_page'] + i for source, _ in unindexed for i in range(source['num_pages'])]
+    if page_numbers:
+        extracted = extract_page_stickers(pdf_document, page_numbers, workers=workers, fast_scan=fast_scan,
+                                          page_progress=page_progress)
+        page_stickers.update(extracted)
+        for source, pdf_hash in unindexed:
+            source_stickers = group_stickers_by_prefix({
+                i + 1: extracted[source['first_page'] + i] for i in range(source['num_pages'])
+                if source['first_page'] + i in extracted})
+            if source_stickers:
+                save_sticker_index(index_dir, pdf_hash, source['num_pages'], source_stickers, fast_scan)
+
+    stickers_by_prefix = group_stickers_by_prefix(dict(sorted(page_stickers.items())))
+    pdf_document['stickers'] = stickers_by_prefix
+    return {prefix: dict(sticker_data) for prefix, sticker_data in stickers_by_prefix.items()}
+
+
+def page_content_hash(page):
+    """Хэш содержимого страницы: поток содержимого и используемые на странице изображения и формы."""
+    digest = hashlib.blake2b(digest_size=20)
+    contents = page.get_contents()
+    if contents is not None:
+        digest.update(contents.get_data())
+    resources = page.get('/Resources')
+    xobjects = resources.get_object().get('/XObject') if resources is not None else None
+    if xobjects is not None:
+        xobjects = xobjects.get_object()
+        for name in sorted(xobjects):
+            digest.update(name.encode('utf-8'))
+            digest.update(xobjects[name].get_object().get_data())
+    return digest.hexdigest()
+
+
+def page_index_path(index_dir):
+    """Файл индекса страниц накопительных PDF."""
+    return Path(index_dir) / PAGE_INDEX_DIR / PAGE_INDEX_FILE
+
+
+def load_page_index(index_dir):
+    """
+    Читает индекс страниц: {хэш страницы: [префикс, номер, выдана ли страница, отправление]}.
+    Префикс и номер — None для страниц без стикера; отправление — строки листа подбора, которой страница
+    досталась при выдаче, иначе None. Повреждённый, отсутствующий или старый индекс считается пустым.
+    """
+    path = page_index_path(index_dir)
+    try:
+        entry = json.loads(path.read_text(encoding='utf-8'))
+        if entry.get('version') != PAGE_INDEX_VERSION or entry.get('prefixes') != sorted(FBS_PREFIXES.values()):
+            return {}
+        return dict(entry['pages'])
+    except (OSError, ValueError, KeyError, AttributeError, TypeError):
+        return {}
+
+
+def save_page_index(index_dir, page_index, max_pages=PAGE_INDEX_MAX_PAGES):
+    """Сохраняет индекс страниц, оставляя не больше max_pages последних записей; ошибки записи не мешают обработке."""
+    if len(page_index) > max_pages:
+        page_index = dict(list(page_index.items())[-max_pages:])
+    path = page_index_path(index_dir)
+    entry = {'version': PAGE_INDEX_VERSION, 'prefixes': sorted(FBS_PREFIXES.values()), 'pages': page_index}
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp_path.write_text(json.dumps(entry, ensure_ascii=False), encoding='utf-8')
+        os.replace(tmp_path, path)
+    except OSError:
+        pass
+
+
+def reset_page_index(index_dir):
+    """Забывает выданные страницы — например, в начале новой смены."""
+    try:
+        page_index_path(index_dir).unlink()
+    except OSError:
+        pass
+
+
+def incremental_sticker_data(pdf_document, page_index, workers=1, fast_scan=True, page_progress=None):
+    """
+    Стикеры накопительного PDF: страницы, уже известные по хэшу содержимого, берутся из индекса страниц,
+    текст извлекается только из остальных; индекс пополняется новыми страницами.
+    Возвращает карты стикеров по префиксам, хэши страниц и номера страниц, которые ещё не выдавались.
+    """
+    page_hashes = {page_num: page_content_hash(page) for page_num, page in pdf_document['pages'].items()}
+    unknown_pages = [page_num for page_num, page_hash in page_hashes.items() if page_hash not in page_index]
+    extracted = extract_page_stickers(pdf_document, unknown_pages, workers=workers, fast_scan=fast_scan,
+                                      page_progress=page_progress)
+    for page_num in unknown_pages:
+        prefix, sticker_number = extracted.get(page_num, (None, None))
+        page_index[page_hashes[page_num]] = [prefix, sticker_number, False, None]
+
+    page_stickers = {}
+    new_pages = []
+    for page_num, page_hash in page_hashes.items():
+        # Запись переносится в конец, чтобы при усечении индекса уходили давно не встречавшиеся страницы.
+        prefix, sticker_number, issued, _ = page_index[page_hash] = page_index.pop(page_hash)
+        if prefix is not None:
+            page_stickers[page_num] = (prefix, sticker_number)
+        if not issued:
+            new_pages.append(page_num)
+    stickers_by_prefix = group_stickers_by_prefix(page_stickers)
+    pdf_document['stickers'] = stickers_by_prefix
+    return stickers_by_prefix, page_hashes, new_pages
+
+
+def current_rss_mb(field='VmRSS'):
+    """Текущий (VmRSS) или пиковый (VmHWM) объём памяти процесса по /proc, МБ; None вне Linux."""
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        return None
+    return None
+
+
+def reset_peak_rss():
+    """
+    Сбрасывает пик памяти процесса (VmHWM) до текущего объёма через /proc/self/clear_refs
+    и возвращает текущий объём, МБ; None вне Linux.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        return None
+    return current_rss_mb()
+
+
+def report_progress(progress, stage, done=0, total=1):
+    """Сообщает progress(этап, доля) долю выполненной работы: пройденные этапы и часть текущего."""
+    if progress is None:
+        return
+    stage_fraction = done / total if total else 1
+    progress(stage, (PIPELINE_STAGES.index(stage) + stage_fraction) / len(PIPELINE_STAGES))
+
+
+@contextmanager
+def measure_stage(metrics, stage, trace_memory=False, progress=None):
+    """
+    Замеряет этап обработки и добавляет запись в список metrics.
+    В запись попадают время, прирост пика памяти процесса за этап (относительно памяти в начале этапа,
+    только в Linux) и, при trace_memory, пик выделений Python за этап; счётчики строк и страниц этап дописывает
+    в полученный словарь сам. О начале этапа сообщается в progress.
+    Память процесса общая: этапы задач, идущих одновременно, попадают в замеры друг друга.
+    Этапы с trace_memory выполняются по одному (TRACE_MEMORY_LOCK).
+    """
+    report_progress(progress, stage)
+    record = {'stage': stage}
+    if metrics is None:
+        yield record
+        return
+
+    with TRACE_MEMORY_LOCK if trace_memory else nullcontext():
+        started_tracing = trace_memory and not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        elif trace_memory:
+            tracemalloc.reset_peak()
+        base_rss = reset_peak_rss()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['seconds'] = round(time.perf_counter() - start, 4)
+            peak_rss = current_rss_mb('VmHWM') if base_rss is not None else None
+            record['stage_peak_rss_mb'] = round(peak_rss - base_rss, 1) if peak_rss is not None else None
+            if trace_memory:
+                record['peak_traced_mb'] = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 2)
+                if started_tracing:
+                    tracemalloc.stop()
+            metrics.append(record)
+
+
+def metrics_to_jsonl(metrics, **context):
+    """Сериализует замеры этапов в JSON Lines; context (время запуска, размеры файлов) добавляется в каждую строку."""
+    return ''.join(json.dumps({**context, **record}, ensure_ascii=False) + '\n' for record in metrics)
+
+
+def append_metrics_log(path, metrics, **context):
+    """Дописывает замеры этапов в файл JSON Lines."""
+    with open(path, 'a', encoding='utf-8') as log_file:
+        log_file.write(metrics_to_jsonl(metrics, **context))
+
+
+def add_order_stickers(df_original, copy=True):
+    """
+    Добавляет стикер из номера заказа и оставляет только строки, где он найден.
+    С copy=False результат не копируется отдельно — для режима low_memory, где исходная таблица дальше не нужна.
+    """
+    df_original['Наименование товара'] = df_original['Наименование товара'].astype(str).fillna('')
+    df_original['Стикер'] = extract_order_number_prefixes(df_original['Номер заказа'])
+    df_with_order_prefix = df_original.dropna(subset=['Стикер'])
+    if copy:
+        df_with_order_prefix = df_with_order_prefix.copy()
+    if df_with_order_prefix.empty:
+        raise ProcessingError(
+            "Не найдено ни одного номера заказа в формате 'число-' в колонке 'Номер заказа' CSV файла. Проверьте формат номеров заказов.",
+            level='warning')
+    return df_with_order_prefix
+
+
+def split_repeats(df_sorted):
+    """Отделяет повторяющиеся отправления и нумерует строки обоих списков сквозным кодом."""
+    df_sorted = df_sorted.reset_index(drop=True)
+
+    df_sorted['Номер отправления для отображения'] = df_sorted['Номер отправления']
+    df_sorted['Стикер для отображения'] = df_sorted['Стикер']
+    repeated = df_sorted.pop('shipment_sticker_repeated_flag')
+    df_repeats = df_sorted[repeated].copy()
+    df_repeats = df_repeats.sort_values(by=['Номер отправления'])
+    df_sorted = df_sorted[~repeated].copy()
+
+    num_rows = len(df_sorted)
+    df_sorted['Код'] = pd.Series(range(1, num_rows + 1), index=df_sorted.index)
+
+    start_num_repeats = df_sorted['Код'].max() + 1 if not df_sorted.empty else 1
+    num_rows_repeats = len(df_repeats)
+    df_repeats['Код'] = pd.Series(range(start_num_repeats, start_num_repeats + num_rows_repeats),
+                                  index=df_repeats.index)
+
+    df_sorted = df_sorted.rename(columns={'Количество': 'Кол-во'})
+    df_repeats = df_repeats.rename(columns={'Количество': 'Кол-во'})
+    return df_sorted, df_repeats
+
+
+def build_excel_frames(df_sorted, df_repeats):
+    """Готовит столбцы листов Excel: основной список и повторы."""
+    display_names = {
+        'Номер отправления для отображения': 'Номер отправления',
+        'Стикер для отображения': 'Стикер'
+    }
+    df_for_excel = df_sorted[DESIRED_COLUMNS].rename(columns=display_names)
+    df_repeats_for_excel = df_repeats[DESIRED_COLUMNS].rename(columns=display_names)
+
+    df_for_excel['Стикер'] = get_last_4_digits(df_for_excel['Стикер'])
+    df_repeats_for_excel['Стикер'] = get_last_4_digits(df_repeats_for_excel['Стикер'])
+    return df_for_excel, df_repeats_for_excel
+
+
+def warm_up():
+    """
+    Заранее выполняет то, что иначе досталось бы первой обработке: ленивые импорты внутри pandas и pyarrow
+    и компиляцию регулярных выражений поиска стикеров и сортировки — прогоном по таблице из одной строки.
+    """
+    sticker_pattern(tuple(FBS_PREFIXES.values()))
+    non_digit_pattern()
+    df = pd.DataFrame({'Номер заказа': ['12345678-0001'], 'Номер отправления': ['12345678-0001-1'],
+                       'Наименование товара': ['Товар'], 'Артикул': ['ART-1k2'], 'Количество': [1]})
+    df_sorted, df_repeats = split_repeats(sort_dataframe(add_order_stickers(df)))
+    build_excel_frames(df_sorted, df_repeats)
+
+
+def process_orders(csv_file, pdf_file, fbs_option=None, workers=1, fast_excel=True, cache=None, metrics=None,
+                   trace_memory=False, fast_scan=True, sticker_index_dir=None, incremental=False, batch_size=None,
+                   low_memory=False, progress=None, compact_pdf=True):
+    """
+    Полный цикл обработки одной пары файлов: CSV заказов и PDF стикеров.
+    Возвращает словарь с готовыми PDF и Excel и списками ненайденных стикеров и лишних страниц.
+    PDF и ZIP возвращаются в буферах new_output_buffer: большие лежат во временном файле на диске,
+    поэтому их читают через output_bytes или save_output, а не getvalue().
+    csv_file и pdf_file могут быть списками файлов одной смены: CSV объединяются в один лист подбора, PDF —
+    в один документ со сквозной нумерацией страниц (см. open_pdf_document). Отправления и стикеры, повторяющиеся
+    в нескольких файлах, берутся из первого файла (см. read_csv_files и drop_repeated_sticker_pages).
+    Если fbs_option не задан, склад определяется по стикерам в PDF — берётся склад с наибольшим числом страниц.
+    Ошибки, которые нужно показать пользователю, выбрасываются как ProcessingError.
+    Если передан список metrics, в него добавляются замеры каждого этапа (см. measure_stage).
+    С каталогом sticker_index_dir стикеры однажды обработанного PDF берутся с диска, без извлечения текста.
+    В режиме incremental (нужен sticker_index_dir) страницы накопительного PDF узнаются по хэшу содержимого:
+    текст извлекается только из новых страниц, а PDF и Excel содержат только новые страницы и их заказы.
+    С batch_size вместо одного PDF возвращается ZIP ('pdf_zip') с пачками по batch_size значений Код листа подбора.
+    В режиме low_memory из CSV читаются только нужные столбцы, таблицы не кэшируются и не копируются,
+    а промежуточные таблицы освобождаются сразу после использования (см. LOW_MEMORY_PEAK_MB_PER_100K_ROWS).
+    progress(этап, доля от 0 до 1) вызывается в начале каждого этапа, по ходу извлечения стикеров и в конце,
+    перед тем как страницы отмечаются выданными; исключение из progress прерывает обработку.
+    С compact_pdf одинаковые шрифты и изображения страниц записываются в итоговый PDF один раз (см. compact_pdf_writer).
+    """
+    if incremental and sticker_index_dir is None:
+        raise ProcessingError("Для обработки только новых страниц нужен каталог индекса стикеров.")
+    # Кэш держит копии таблиц, поэтому в режиме low_memory таблицы CSV не кэшируются.
+    table_cache = None if low_memory else cache
+    csv_files = list(csv_file) if isinstance(csv_file, (list, tuple)) else [csv_file]
+    pdf_files = list(pdf_file) if isinstance(pdf_file, (list, tuple)) else [pdf_file]
+    csv_hash = (combined_content_hash([file_content_hash(f) for f in csv_files])
+                if table_cache is not None else None)
+    pdf_hashes = ([file_content_hash(f) for f in pdf_files]
+                  if cache is not None or sticker_index_dir is not None else None)
+    pdf_hash = combined_content_hash(pdf_hashes) if pdf_hashes is not None else None
+
+    with measure_stage(metrics, 'csv_read', trace_memory, progress) as stage:
+        df_original = cached_result(table_cache, ('csv', csv_hash),
+                                    lambda: read_csv_files(csv_files, low_memory=low_memory, workers=workers))
+        stage['rows'] = len(df_original)
+        stage['files'] = len(csv_files)
+    csv_format = df_original.attrs.get('csv_format', {})
+    repeated_shipments = df_original.attrs.get('repeated_shipments', 0)
+
+    with measure_stage(metrics, 'sort', trace_memory, progress) as stage:
+        df_with_order_prefix = add_order_stickers(df_original, copy=not low_memory)
+        del df_original
+        if low_memory:
+            df_sorted = sort_dataframe(df_with_order_prefix)
+            if not incremental:
+                del df_with_order_prefix
+        else:
+            df_sorted = cached_result(table_cache, ('sort', csv_hash),
+                                      lambda: sort_dataframe(df_with_order_prefix.copy()))
+        df_sorted, df_repeats = split_repeats(df_sorted)
+        stage['rows'] = len(df_sorted) + len(df_repeats)
+
+    with measure_stage(metrics, 'pdf_open', trace_memory, progress) as stage:
+        pdf_document = open_pdf_document(pdf_files)
+        stage['pages'] = pdf_document['num_pages']
+        stage['files'] = len(pdf_files)
+
+    def page_progress(done, total):
+        report_progress(progress, 'pdf_extract', done, total)
+
+    # Задачи из разных сессий выполняются в одном процессе: индекс выданных страниц меняет одна задача за раз.
+    with PAGE_INDEX_LOCK if incremental else nullcontext():
+        page_index = load_page_index(sticker_index_dir) if incremental else None
+        new_pages = None
+        try:
+            with measure_stage(metrics, 'pdf_extract', trace_memory, progress) as stage:
+                if incremental:
+                    stickers_by_prefix, page_hashes, new_pages = incremental_sticker_data(
+                        pdf_document, page_index, workers, fast_scan, page_progress)
+                    stage['new_pages'] = len(new_pages)
+                else:
+                    stickers_by_prefix = cached_result(
+                        cache, ('stickers', pdf_hash, fast_scan),
+                        lambda: indexed_sticker_data(pdf_document, pdf_hashes, sticker_index_dir, workers,
+                                                     fast_scan, page_progress) or None) or {}
+                stickers_by_prefix, repeated_pages = drop_repeated_sticker_pages(pdf_document, stickers_by_prefix)
+                pdf_document['stickers'] = stickers_by_prefix
+                num_pdf_pages = pdf_document['num_pages'] - len(repeated_pages)
+                warehouses = detect_warehouses(stickers_by_prefix)
+                stage['pages'] = num_pdf_pages
+                stage['stickers'] = sum(warehouses.values())
+
+            if not warehouses:
+                known_formats = ', '.join(f"'FBS: {prefix} XXXXX'" for prefix in FBS_PREFIXES.values())
+                raise ProcessingError(
+                    f"Не удалось извлечь ни одного стикера из PDF файла. Проверьте, соответствует ли формат стикера одному из шаблонов: {known_formats}.",
+                    level='warning')
+            if fbs_option is None:
+                fbs_option = next(iter(warehouses))
+            elif fbs_option not in warehouses:
+                raise ProcessingError(
+                    f"В PDF нет стикеров склада {fbs_option}. Найдены стикеры склада: {', '.join(warehouses)}. Выберите другой склад.",
+                    level='warning')
+            pdf_sticker_data = stickers_by_prefix[FBS_PREFIXES[fbs_option]]
+
+            if incremental:
+                with measure_stage(metrics, 'delta', trace_memory, progress) as stage:
+                    pdf_sticker_data = {page_num: pdf_sticker_data[page_num] for page_num in new_pages
+                                        if page_num in pdf_sticker_data}
+                    if not pdf_sticker_data:
+                        raise ProcessingError(
+                            f"Новых стикеров склада {fbs_option} нет: все страницы этого PDF уже обработаны.",
+                            level='warning')
+                    # Лист подбора строится заново только по заказам с новых страниц. Отправления, страницы
+                    # которых уже выданы, в него не попадают: у заказа могут быть отправления из разных волн.
+                    delta_mask = df_with_order_prefix['Стикер'].isin(set(pdf_sticker_data.values()))
+                    issued_shipments = {page_index[page_hash][3] for page_hash in page_hashes.values()
+                                        if page_index[page_hash][2] and page_index[page_hash][3] is not None}
+                    if issued_shipments and 'Номер отправления' in df_with_order_prefix.columns:
+                        delta_mask &= ~df_with_order_prefix['Номер отправления'].astype(str).isin(issued_shipments)
+                    df_delta = df_with_order_prefix[delta_mask]
+                    df_sorted, df_repeats = split_repeats(sort_dataframe(df_delta.copy()))
+                    num_pdf_pages = len(pdf_sticker_data)
+                    stage['pages'] = num_pdf_pages
+                    stage['rows'] = len(df_sorted) + len(df_repeats)
+
+            with measure_stage(metrics, 'match', trace_memory, progress) as stage:
+                pdf_pages_in_csv_order, missing_pdf_pages, unused_pages, page_codes = match_stickers_to_pages(
+                    df_sorted, df_repeats, pdf_sticker_data)
+                stage['rows'] = len(df_sorted) + len(df_repeats)
+                stage['matched'] = len(pdf_pages_in_csv_order)
+                if incremental:
+                    page_shipments = match_page_shipments(df_sorted, df_repeats, pdf_pages_in_csv_order, page_codes)
+            if not pdf_pages_in_csv_order:
+                raise ProcessingError(
+                    "Не удалось найти соответствие между идентификаторами из CSV и стикерами из PDF. Переупорядочивание PDF невозможно.")
+
+            with measure_stage(metrics, 'excel', trace_memory, progress) as stage:
+                df_for_excel, df_repeats_for_excel = build_excel_frames(df_sorted, df_repeats)
+                if low_memory:
+                    del df_sorted, df_repeats
+                excel_buffer = customize_excel(df_for_excel, df_repeats_for_excel, fbs_option, num_pdf_pages,
+                                               fast=fast_excel)
+                stage['rows'] = len(df_for_excel) + len(df_repeats_for_excel)
+                stage['fast'] = fast_excel
+
+            with measure_stage(metrics, 'pdf_write', trace_memory, progress) as stage:
+                pdf_output_buffer = None
+                pdf_zip_buffer = None
+                if batch_size:
+                    pdf_zip_buffer = write_pdf_batches_zip(pdf_document, pdf_pages_in_csv_order, page_codes, batch_size,
+                                                           workers, compact_pdf)
+                    stage['batch_size'] = batch_size
+                    stage['bytes'] = pdf_zip_buffer.seek(0, io.SEEK_END)
+                    pdf_zip_buffer.seek(0)
+                else:
+                    reordered_pdf_writer = reorder_pdf_pages(pdf_document, pdf_pages_in_csv_order, compact_pdf)
+                    pdf_output_buffer = new_output_buffer()
+                    reordered_pdf_writer.write(pdf_output_buffer)
+                    del reordered_pdf_writer
+                    stage['bytes'] = pdf_output_buffer.tell()
+                    pdf_output_buffer.seek(0)
+                stage['pages'] = len(pdf_pages_in_csv_order)
+                stage['compact'] = compact_pdf
+            pdf_sources = summarize_pdf_sources(pdf_document, pdf_pages_in_csv_order, repeated_pages)
+            repeated_page_origins = [page_origin(pdf_document, page_num) for page_num in repeated_pages]
+
+            # Последний отчёт о ходе работы — и последняя точка отмены фоновой задачи: отменённая задача
+            # прерывается здесь и не отмечает выданными страницы, которые пользователь не получит.
+            report_progress(progress, 'pdf_write', 1, 1)
+            if incremental:
+                # Выданными отмечаются только страницы, попавшие в результат, и страницы без стикеров.
+                # Стикеры, которых нет в CSV, остаются новыми и попадут в следующую выдачу.
+                # С выданной страницей запоминается её отправление, чтобы следующие волны не включали его
+                # в лист подбора снова.
+                issued_pages = {page_num for page_num, _ in pdf_pages_in_csv_order}
+                for page_num in new_pages:
+                    entry = page_index[page_hashes[page_num]]
+                    if page_num in issued_pages or entry[0] is None:
+                        entry[2] = True
+                        entry[3] = page_shipments.get(page_num)
+        finally:
+            close_pdf_document(pdf_document)
+            if incremental:
+                save_page_index(sticker_index_dir, page_index)
+
+    return {
+        'excel': excel_buffer,
+        'pdf': pdf_output_buffer,
+        'pdf_zip': pdf_zip_buffer,
+        'csv_format': csv_format,
+        'fbs_option': fbs_option,
+        'warehouses': warehouses,
+        'num_pdf_pages': num_pdf_pages,
+        'new_pages': len(new_pages) if new_pages is not None else None,
+        'missing_pdf_pages': missing_pdf_pages,
+        'unused_pages': unused_pages,
+        'pdf_sources': pdf_sources,
+        'repeated_pages': repeated_page_origins,
+        'repeated_shipments': repeated_shipments,
+    }
@@ -0,0 +1,364 @@
+"""
+Проверка равносильности оптимизированных реализаций порядка подбора эталонной.
+
+Пример:
+    python ozon_equivalence.py
+    python ozon_equivalence.py --engine my_fast_sort --pair orders.csv labels.pdf
+
+Порядок листа подбора задаётся 13 ключами сортировки, а от него зависят Код строк, лист Повторы
+и порядок страниц PDF. Здесь лежат замороженные копии первоначальных построчных реализаций
+(сортировка через sort_values, отделение повторов, поиск страницы перебором) — это эталон.
+Проверяемый движок — модуль с функциями sort_dataframe, split_repeats, match_stickers_to_pages
+и reorder_pdf_pages; недостающие берутся из ozon_core, без --engine проверяется сам ozon_core.
+Оба прогоняются на синтетических данных ozon_bench (см. GENERATED_CASES) и на записанных парах
+CSV/PDF; сравниваются порядок строк, Код, состав и порядок Повторов, сопоставление страниц
+и последовательность страниц итогового PDF, и для каждого случая выводится ускорение.
+Вместе с синтетическими случаями проверяется накопительный режим (см. check_incremental_waves).
+"""
+import argparse
+import importlib
+import io
+import json
+import re
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from pypdf import PdfReader, PdfWriter
+
+import ozon_bench
+import ozon_core
+
+# Синтетические случаи: (имя, параметры generate_orders_csv, число страниц PDF или None — по числу отправлений).
+GENERATED_CASES = [
+    ('gen_small', {'num_orders': 200, 'seed': 1}, None),
+    ('gen_medium', {'num_orders': 2000, 'seed': 2}, None),
+    ('gen_repeats', {'num_orders': 1000, 'seed': 3, 'repeat_share': 0.6, 'multi_shipment_share': 0.4}, None),
+    ('gen_missing_pages', {'num_orders': 1000, 'seed': 4}, 900),
+    ('gen_extra_pages', {'num_orders': 500, 'seed': 5}, 800),
+]
+
+ENGINE_FUNCTIONS = ['sort_dataframe', 'split_repeats', 'match_stickers_to_pages', 'reorder_pdf_pages']
+
+# Сравниваемые результаты: (ключ, подпись в отчёте).
+ASPECTS = [
+    ('order', 'порядок строк'),
+    ('repeats', 'Повторы'),
+    ('codes', 'Код'),
+    ('page_order', 'страницы по строкам'),
+    ('pdf', 'страницы PDF'),
+    ('missing', 'ненайденные'),
+    ('unused', 'лишние страницы'),
+]
+
+# Столбец с исходным номером строки: по нему сравниваются порядок и Код.
+ROW_COLUMN = '__row'
+
+
+def reference_sort_dataframe(df):
+    """Эталонная сортировка: первоначальная реализация через sort_values по 13 ключам."""
+    required_cols = ['Артикул', 'Количество', 'Наименование товара', 'Номер отправления', 'Стикер']
+    for col in required_cols:
+        if col not in df.columns:
+            df[col] = ''
+
+    df['Количество'] = pd.to_numeric(df['Количество'], errors='coerce').fillna(0)
+    original_article_case = df['Артикул'].astype(str)
+    df['Артикул_lower'] = df['Артикул'].astype(str).str.lower()
+    df['Наименование товара_lower'] = df['Наименование товара'].astype(str).str.lower()
+
+    def get_article_core(article):
+        match = re.search(r'([a-z]\d+)$', article)
+        if match:
+            return article[:match.start()].strip()
+        return article.strip()
+
+    df['article_core'] = df['Артикул_lower'].apply(get_article_core)
+    df['core_repeat_count'] = df['article_core'].map(df['article_core'].value_counts())
+    df['full_sticker_repeat_count'] = df['Артикул_lower'].map(df['Артикул_lower'].value_counts())
+
+    df['shipment_sticker_key'] = df['Номер отправления'].astype(str) + '_' + df['Стикер'].astype(str)
+    df['shipment_sticker_repeated'] = df['shipment_sticker_key'].map(df['shipment_sticker_key'].value_counts())
+    df['shipment_sticker_repeated_flag'] = df['shipment_sticker_repeated'] > 1
+
+    df['has_k_prefix_num'] = df['Артикул_lower'].str.contains(r'.*[k][2-5]\d*.*', na=False)
+    df['qty_greater_than_1'] = df['Количество'] > 1
+    df['article_repeated'] = df['full_sticker_repeat_count'] > 1
+
+    df['name_article_key'] = df['Наименование товара_lower'].astype(str) + '_' + df['Артикул_lower'].astype(str)
+    df['name_article_repeated'] = df['name_article_key'].map(df['name_article_key'].value_counts())
+
+    k_match = df['Артикул_lower'].str.extract(r'.*[k]([2-6]\d*)$', expand=False)
+    df['k_num_suffix'] = pd.to_numeric(k_match, errors='coerce').fillna(0)
+
+    df['sort_level'] = 4.0
+    priority1_mask = (df['core_repeat_count'] > 1) & (df['has_k_prefix_num'])
+    df.loc[priority1_mask, 'sort_level'] = 1.0
+    priority2_mask = (df['full_sticker_repeat_count'] > 1) & (df['qty_greater_than_1']) & (df['sort_level'] == 4.0)
+    df.loc[priority2_mask, 'sort_level'] = 2.0
+    priority3_mask = (df['full_sticker_repeat_count'] > 1) & (df['sort_level'] == 4.0)
+    df.loc[priority3_mask, 'sort_level'] = 3.0
+
+    df = df.sort_values(
+        by=['shipment_sticker_repeated_flag', 'has_k_prefix_num', 'k_num_suffix', 'qty_greater_than_1',
+            'article_repeated', 'name_article_repeated', 'sort_level', 'article_core', 'core_repeat_count',
+            'Количество', 'core_repeat_count', 'Наименование товара_lower', 'Артикул_lower'],
+        ascending=[False, False, False, False, False, False, True, True, False, False, False, True, True]
+    )
+
+    df['Артикул'] = original_article_case
+    return df
+
+
+def reference_split_repeats(df_sorted):
+    """Эталонное отделение Повторов и нумерация Код — как в первоначальной странице Streamlit."""
+    df_sorted['Номер отправления для отображения'] = df_sorted['Номер отправления']
+    df_sorted['Стикер для отображения'] = df_sorted['Стикер']
+    df_repeats = df_sorted[df_sorted['shipment_sticker_repeated_flag']].copy()
+    df_repeats = df_repeats.sort_values(by=['Номер отправления'])
+    df_sorted = df_sorted[~df_sorted['shipment_sticker_repeated_flag']].copy()
+
+    num_rows = len(df_sorted)
+    df_sorted['Код'] = pd.Series(range(1, num_rows + 1), index=df_sorted.index)
+    start_num_repeats = df_sorted['Код'].max() + 1 if not df_sorted.empty else 1
+    df_repeats['Код'] = pd.Series(range(start_num_repeats, start_num_repeats + len(df_repeats)),
+                                  index=df_repeats.index)
+
+    df_sorted = df_sorted.rename(columns={'Количество': 'Кол-во'})
+    df_repeats = df_repeats.rename(columns={'Количество': 'Кол-во'})
+    return df_sorted, df_repeats
+
+
+def reference_match_stickers_to_pages(df_sorted, df_repeats, pdf_sticker_data):
+    """Эталонное сопоставление: каждая строка перебором забирает первую оставшуюся страницу со своим стикером."""
+    pdf_sticker_data = dict(pdf_sticker_data)
+    pdf_pages_in_csv_order = []
+    missing_pdf_pages = []
+    page_codes = []
+    for df in (df_sorted, df_repeats):
+        for _, row in df.iterrows():
+            csv_identifier = row['Стикер']
+            found_page = None
+            for page_num, pdf_sticker_value in pdf_sticker_data.items():
+                if pdf_sticker_value == csv_identifier:
+                    found_page = (page_num, pdf_sticker_value)
+                    del pdf_sticker_data[page_num]
+                    break
+            if found_page:
+                pdf_pages_in_csv_order.append(found_page)
+                page_codes.append(row['Код'])
+            else:
+                missing_pdf_pages.append(csv_identifier)
+    return pdf_pages_in_csv_order, missing_pdf_pages, pdf_sticker_data, page_codes
+
+
+def reference_reorder_pdf_pages(pdf_document, page_order_mapping):
+    """Эталонная сборка PDF: страницы добавляются по одной в порядке сопоставления."""
+    writer = PdfWriter()
+    for original_page_num, _ in page_order_mapping:
+        writer.add_page(pdf_document['pages'][original_page_num])
+    return writer
+
+
+REFERENCE_ENGINE = {
+    'sort_dataframe': reference_sort_dataframe,
+    'split_repeats': reference_split_repeats,
+    'match_stickers_to_pages': reference_match_stickers_to_pages,
+    'reorder_pdf_pages': reference_reorder_pdf_pages,
+}
+
+
+def load_engine(module_name=None):
+    """Функции проверяемого движка из модуля module_name; недостающие (или все, без модуля) — из ozon_core."""
+    module = importlib.import_module(module_name) if module_name else ozon_core
+    return {name: getattr(module, name, getattr(ozon_core, name)) for name in ENGINE_FUNCTIONS}
+
+
+def run_engine(engine, df_orders, pdf_document, sticker_data):
+    """
+    Прогоняет сортировку, отделение Повторов, сопоставление и сборку PDF одного движка.
+    Возвращает сравниваемые результаты (см. ASPECTS) и время работы движка, сек.
+    """
+    df = df_orders.copy()
+    start = time.perf_counter()
+    df_sorted, df_repeats = engine['split_repeats'](engine['sort_dataframe'](df))
+    page_order, missing, unused, page_codes = engine['match_stickers_to_pages'](df_sorted, df_repeats, sticker_data)
+    pdf_buffer = io.BytesIO()
+    engine['reorder_pdf_pages'](pdf_document, page_order).write(pdf_buffer)
+    seconds = time.perf_counter() - start
+
+    pdf_buffer.seek(0)
+    return {
+        'order': df_sorted[ROW_COLUMN].tolist(),
+        'repeats': df_repeats[ROW_COLUMN].tolist(),
+        'codes': sorted(zip(pd.concat([df_sorted[ROW_COLUMN], df_repeats[ROW_COLUMN]]).tolist(),
+                            pd.concat([df_sorted['Код'], df_repeats['Код']]).astype(int).tolist())),
+        'page_order': [(int(page_num), sticker, int(code)) for (page_num, sticker), code in zip(page_order, page_codes)],
+        'pdf': [ozon_core.page_content_hash(page) for page in PdfReader(pdf_buffer).pages],
+        'missing': list(missing),
+        'unused': sorted((int(page_num), sticker) for page_num, sticker in dict(unused).items()),
+    }, seconds
+
+
+def describe_difference(expected, actual):
+    """Первое расхождение двух последовательностей или None, если они совпадают."""
+    if expected == actual:
+        return None
+    for i, (left, right) in enumerate(zip(expected, actual)):
+        if left != right:
+            return f"позиция {i}: эталон {left!r}, движок {right!r}"
+    return f"длина: эталон {len(expected)}, движок {len(actual)}"
+
+
+def compare_case(name, csv_bytes, pdf_bytes, engine, fbs_option=None, repeats=1):
+    """Сравнивает движок с эталоном на одной паре CSV/PDF; время каждого — лучшее из repeats прогонов."""
+    df_orders = ozon_core.add_order_stickers(ozon_core.read_csv_with_encoding(io.BytesIO(csv_bytes)))
+    df_orders[ROW_COLUMN] = np.arange(len(df_orders))
+    pdf_document = ozon_core.open_pdf_document(io.BytesIO(pdf_bytes))
+    try:
+        stickers_by_prefix = ozon_core.extract_sticker_data_from_pdf(pdf_document)
+        warehouses = ozon_core.detect_warehouses(stickers_by_prefix)
+        if not warehouses:
+            raise ozon_core.ProcessingError(f"{name}: в PDF не найдено ни одного стикера.")
+        fbs_option = fbs_option or next(iter(warehouses))
+        sticker_data = stickers_by_prefix[ozon_core.FBS_PREFIXES[fbs_option]]
+
+        reference_seconds = []
+        engine_seconds = []
+        for _ in range(repeats):
+            expected, seconds = run_engine(REFERENCE_ENGINE, df_orders, pdf_document, sticker_data)
+            reference_seconds.append(seconds)
+            actual, seconds = run_engine(engine, df_orders, pdf_document, sticker_data)
+            engine_seconds.append(seconds)
+    finally:
+        ozon_core.close_pdf_document(pdf_document)
+
+    differences = {aspect: describe_difference(expected[aspect], actual[aspect]) for aspect, _ in ASPECTS}
+    return {
+        'case': name,
+        'rows': len(df_orders),
+        'pages': len(sticker_data),
+        'fbs': fbs_option,
+        'differences': {aspect: diff for aspect, diff in differences.items() if diff is not None},
+        'reference_seconds': min(reference_seconds),
+        'engine_seconds': min(engine_seconds),
+        'speedup': min(reference_seconds) / min(engine_seconds) if min(engine_seconds) else None,
+    }
+
+
+def generated_inputs(scale=1.0):
+    """Синтетические пары CSV/PDF по GENERATED_CASES; scale умножает число заказов и страниц."""
+    for name, params, num_pages in GENERATED_CASES:
+        params = dict(params, num_orders=max(10, int(params['num_orders'] * scale)))
+        csv_bytes, stickers = ozon_bench.generate_orders_csv(**params)
+        if num_pages is not None:
+            num_pages = max(1, int(num_pages * scale))
+        yield name, csv_bytes, ozon_bench.generate_labels_pdf(stickers, ozon_core.FBS_PREFIXES['Озон'], num_pages)
+
+
+def recorded_inputs(pairs):
+    """Записанные пары CSV/PDF с диска; имя случая — имя PDF."""
+    for csv_path, pdf_path in pairs:
+        yield Path(pdf_path).name, Path(csv_path).read_bytes(), Path(pdf_path).read_bytes()
+
+
+def check_incremental_waves():
+    """
+    Накопительный режим на двух волнах: у заказа 11111111 отправление -1 в первой волне и -2 во второй.
+    Вторая волна должна выдать одну страницу — отправления -2 — и только его строку листа подбора.
+    Возвращает список расхождений; пустой — проверка пройдена.
+    """
+    header = 'Номер заказа;Номер отправления;Наименование товара;Артикул;Количество'
+    wave1_rows = ['11111111-0001;11111111-0001-1;Товар A;ART-A;1', '22222222-0001;22222222-0001-1;Товар C;ART-C;1']
+    wave2_rows = wave1_rows + ['11111111-0001;11111111-0001-2;Товар B;ART-B;1']
+    fbs_prefix = ozon_core.FBS_PREFIXES['Озон']
+    waves = [
+        (wave1_rows, ['11111111', '22222222'], {'11111111-0001-1', '22222222-0001-1'}),
+        (wave2_rows, ['11111111', '22222222', '11111111'], {'11111111-0001-2'}),
+    ]
+    problems = []
+    with tempfile.TemporaryDirectory() as index_dir:
+        for wave_num, (rows, stickers, expected_shipments) in enumerate(waves, start=1):
+            csv_bytes = ('\n'.join([header] + rows) + '\n').encode('utf-8')
+            result = ozon_core.process_orders(io.BytesIO(csv_bytes),
+                                              io.BytesIO(ozon_bench.generate_labels_pdf(stickers, fbs_prefix)),
+                                              'Озон', sticker_index_dir=index_dir, incremental=True)
+            sheets = pd.read_excel(io.BytesIO(ozon_core.output_bytes(result['excel'])), sheet_name=None, header=None)
+            cells = {str(value) for sheet in sheets.values() for value in sheet.to_numpy().ravel()}
+            listed_shipments = {value for value in cells if re.fullmatch(r'\d+-\d+-\d+', value)}
+            page_texts = [page.extract_text() for page in
+                          PdfReader(io.BytesIO(ozon_core.output_bytes(result['pdf']))).pages]
+            page_shipments = {shipment for text in page_texts for shipment in re.findall(r'\d+-\d+-\d+', text)}
+            if listed_shipments != expected_shipments:
+                problems.append(f"волна {wave_num}: в листе подбора {sorted(listed_shipments)}, "
+                                f"ожидались {sorted(expected_shipments)}")
+            if len(page_texts) != len(expected_shipments) or page_shipments != expected_shipments:
+                problems.append(f"волна {wave_num}: страницы PDF {sorted(page_shipments)} ({len(page_texts)} стр.), "
+                                f"ожидались {sorted(expected_shipments)}")
+    return problems
+
+
+def format_report(results):
+    """Таблица случаев с ускорением и расхождениями под каждым несовпавшим случаем."""
+    lines = [f"{'случай':<22}{'строк':>8}{'стр.':>8}{'эталон, с':>12}{'движок, с':>12}{'ускорение':>11}  итог"]
+    for result in results:
+        speedup = f"{result['speedup']:.1f}x" if result['speedup'] else '-'
+        verdict = 'совпадает' if not result['differences'] else 'РАСХОДИТСЯ'
+        lines.append(f"{result['case']:<22}{result['rows']:>8}{result['pages']:>8}{result['reference_seconds']:>12.3f}"
+                     f"{result['engine_seconds']:>12.3f}{speedup:>11}  {verdict}")
+        labels = dict(ASPECTS)
+        for aspect, diff in result['differences'].items():
+            lines.append(f"    {labels[aspect]}: {diff}")
+    return '\n'.join(lines)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Сравнение порядка подбора и страниц PDF с эталонной реализацией.")
+    parser.add_argument('--engine', default=None,
+                        help="Модуль проверяемого движка (по умолчанию — ozon_core)")
+    parser.add_argument('--pair', nargs=2, action='append', default=[], metavar=('CSV', 'PDF'),
+                        help="Записанная пара CSV и PDF (можно указать несколько раз)")
+    parser.add_argument('--fbs', choices=list(ozon_core.FBS_PREFIXES.keys()), default=None,
+                        help="Склад для записанных пар (по умолчанию — по стикерам в PDF)")
+    parser.add_argument('--scale', type=float, default=1.0, help="Множитель размера синтетических случаев")
+    parser.add_argument('--no-generated', action='store_true', help="Только записанные пары, без синтетических")
+    parser.add_argument('--repeat', type=int, default=1, help="Число прогонов для замера времени")
+    parser.add_argument('--json', action='store_true', help="Вывести результат в JSON")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    engine = load_engine(args.engine)
+    inputs = [] if args.no_generated else list(generated_inputs(args.scale))
+    inputs += list(recorded_inputs(args.pair))
+    if not inputs:
+        print("Нет случаев для сравнения: укажите --pair или уберите --no-generated.", file=sys.stderr)
+        return 2
+
+    results = []
+    for name, csv_bytes, pdf_bytes in inputs:
+        try:
+            results.append(compare_case(name, csv_bytes, pdf_bytes, engine, args.fbs, max(1, args.repeat)))
+        except ozon_core.ProcessingError as e:
+            print(f"{name}: {e}", file=sys.stderr)
+            return 2
+
+    incremental_problems = [] if args.no_generated else check_incremental_waves()
+
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+    else:
+        print(format_report(results))
+        if not args.no_generated:
+            print(f"накопительный режим: {'совпадает' if not incremental_problems else 'РАСХОДИТСЯ'}")
+    for problem in incremental_problems:
+        print(f"    {problem}", file=sys.stderr if args.json else sys.stdout)
+    return 1 if incremental_problems or any(result['differences'] for result in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
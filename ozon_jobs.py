@@ -0,0 +1,144 @@
+"""
+Очередь фоновых задач обработки.
+
+Скрипт Streamlit перезапускается при каждом действии пользователя, поэтому долгая
+обработка внутри него замораживает страницу. Задача отправляется в общий пул
+потоков и получает идентификатор; страница только опрашивает её состояние и
+забирает результат, когда он готов. Число одновременных задач ограничено
+размером пула — остальные ждут в очереди. Тяжёлое чтение PDF внутри задачи
+по-прежнему может идти в пуле процессов (параметр workers у process_orders).
+
+Задачу можно отменить: ждущая в очереди не запускается, а выполняющаяся
+останавливается при следующем отчёте о ходе работы — функция progress
+выбрасывает JobCancelled.
+"""
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+# Сколько задач обрабатывается одновременно; остальные ждут в очереди.
+DEFAULT_MAX_JOBS = int(os.environ.get("OZON_MAX_JOBS", 2))
+
+# Сколько секунд хранится завершённая задача, если её результат так и не забрали.
+JOB_TTL_SECONDS = 3600
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+JOB_CANCELLED = 'cancelled'
+
+
+class JobCancelled(Exception):
+    """Задача отменена: выбрасывается из progress, чтобы прервать её выполнение."""
+
+
+def new_job_queue(max_jobs=DEFAULT_MAX_JOBS):
+    """Создаёт очередь задач с ограничением числа одновременно выполняемых задач."""
+    return {
+        'executor': ThreadPoolExecutor(max_workers=max(1, max_jobs), thread_name_prefix='ozon-job'),
+        'jobs': {},
+        'lock': threading.Lock(),
+        'max_jobs': max(1, max_jobs),
+    }
+
+
+def run_job(queue, job, func, args, kwargs):
+    """
+    Выполняет задачу в потоке пула, передавая ей функцию progress(этап, доля) для отчёта о ходе работы.
+    Если задача отменена, progress выбрасывает JobCancelled.
+    """
+    def progress(stage, fraction):
+        with queue['lock']:
+            if job['cancelled']:
+                raise JobCancelled()
+            job['stage'] = stage
+            job['progress'] = min(max(fraction, 0.0), 1.0)
+
+    with queue['lock']:
+        if job['cancelled']:
+            return
+        job['status'] = JOB_RUNNING
+        job['started_at'] = time.time()
+    try:
+        result = func(*args, progress=progress, **kwargs)
+    except JobCancelled:
+        with queue['lock']:
+            job['status'] = JOB_CANCELLED
+            job['finished_at'] = time.time()
+    except Exception as e:
+        with queue['lock']:
+            job['status'] = JOB_FAILED
+            job['error'] = e
+            job['finished_at'] = time.time()
+    else:
+        with queue['lock']:
+            job['status'] = JOB_DONE
+            job['result'] = result
+            job['progress'] = 1.0
+            job['finished_at'] = time.time()
+
+
+def submit_job(queue, func, *args, **kwargs):
+    """
+    Ставит func(*args, progress=..., **kwargs) в очередь и возвращает идентификатор задачи.
+    Заодно удаляет из очереди задачи, завершённые дольше JOB_TTL_SECONDS назад.
+    """
+    cleanup_jobs(queue)
+    job = {
+        'id': uuid.uuid4().hex,
+        'status': JOB_QUEUED,
+        'stage': None,
+        'progress': 0.0,
+        'result': None,
+        'error': None,
+        'submitted_at': time.time(),
+        'started_at': None,
+        'finished_at': None,
+        'cancelled': False,
+        'future': None,
+    }
+    with queue['lock']:
+        queue['jobs'][job['id']] = job
+        job['future'] = queue['executor'].submit(run_job, queue, job, func, args, kwargs)
+    return job['id']
+
+
+def cancel_job(queue, job_id):
+    """
+    Отменяет задачу, результат которой больше не нужен: ждущая в очереди снимается с неё и не занимает место
+    в пуле, выполняющаяся прерывается при следующем отчёте о ходе работы. Завершённые задачи не меняются.
+    """
+    with queue['lock']:
+        job = queue['jobs'].get(job_id)
+        if job is None or job['status'] in (JOB_DONE, JOB_FAILED, JOB_CANCELLED):
+            return
+        job['cancelled'] = True
+        if job['future'].cancel():
+            job['status'] = JOB_CANCELLED
+            job['finished_at'] = time.time()
+
+
+def get_job(queue, job_id):
+    """Снимок состояния задачи (копия словаря) или None, если задачи нет или она уже удалена."""
+    with queue['lock']:
+        job = queue['jobs'].get(job_id)
+        if job is None:
+            return None
+        snapshot = dict(job)
+        if snapshot['status'] == JOB_QUEUED:
+            snapshot['position'] = sum(1 for other in queue['jobs'].values()
+                                       if other['status'] == JOB_QUEUED and other['submitted_at'] <= job['submitted_at'])
+        return snapshot
+
+
+def cleanup_jobs(queue, ttl=JOB_TTL_SECONDS):
+    """Удаляет задачи, завершённые дольше ttl секунд назад, вместе с их результатами."""
+    deadline = time.time() - ttl
+    with queue['lock']:
+        expired = [job_id for job_id, job in queue['jobs'].items()
+                   if job['finished_at'] is not None and job['finished_at'] < deadline]
+        for job_id in expired:
+            del queue['jobs'][job_id]
@@ -0,0 +1,279 @@
+"""
+Функции для рабочих процессов.
+
+Streamlit исполняет ozon.py как скрипт, поэтому функции из него нельзя
+передать в ProcessPoolExecutor — всё, что выполняется в дочерних
+процессах, должно лежать в импортируемом модуле.
+"""
+import io
+import mmap
+import multiprocessing
+import re
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+from pypdf import PdfReader, PdfWriter
+
+# Минимальное число страниц на один процесс: на маленьких PDF запуск пула дороже самого извлечения.
+MIN_PAGES_PER_WORKER = 50
+
+# Сколько частей приходится на один процесс — для равномерной загрузки.
+CHUNKS_PER_WORKER = 4
+
+# Строки текста в потоке содержимого: массив [...] перед TJ или одиночная строка перед Tj, ' и ".
+TEXT_RUN_RE = re.compile(
+    rb'\[((?:\\.|[^\\\]])*)\]\s*TJ'
+    rb'|(\((?:\\.|[^\\()]|\((?:\\.|[^\\()])*\))*\)|<[0-9A-Fa-f\s]*>)\s*(Tj|\'|")'
+)
+# Операторы между фрагментами, после которых текст продолжается с новой строки.
+LINE_BREAK_RE = re.compile(rb'T\*|\bET\b|\bTm\b|(-?[\d.]+)\s+(-?[\d.]+)\s+T[dD]\b')
+PDF_STRING_RE = re.compile(rb'\((?:\\.|[^\\()]|\((?:\\.|[^\\()])*\))*\)|<[0-9A-Fa-f\s]*>')
+# Элементы массива TJ: строка или смещение (число, группа 1).
+TJ_ITEM_RE = re.compile(PDF_STRING_RE.pattern + rb'|([-+]?(?:\d+\.?\d*|\.\d+))')
+PDF_ESCAPE_RE = re.compile(rb'\\([0-7]{1,3}|\r\n|.)', re.DOTALL)
+PDF_ESCAPES = {b'n': b'\n', b'r': b'\r', b't': b'\t', b'b': b'\b', b'f': b'\f', b'\r\n': b'', b'\n': b'', b'\r': b''}
+
+_worker_readers = []
+_worker_first_pages = []
+
+
+@lru_cache(maxsize=None)
+def sticker_pattern(fbs_prefixes):
+    """
+    Один скомпилированный шаблон 'FBS: <префикс> <номер>' сразу для всех префиксов.
+    Длинные префиксы идут первыми, чтобы короткий не перехватил начало длинного.
+    """
+    alternatives = '|'.join(re.escape(prefix) for prefix in sorted(fbs_prefixes, key=len, reverse=True))
+    return re.compile(r"FBS:\s*(" + alternatives + r")\s*(\d+)")
+
+
+def find_sticker_in_text(text, fbs_prefixes):
+    """Ищет 'FBS: <префикс> <номер>' в тексте страницы и возвращает пару (префикс, номер)."""
+    if not text:
+        return None
+    match = sticker_pattern(fbs_prefixes).search(text)
+    if match:
+        return match.group(1), match.group(2)
+    else:
+        return None
+
+
+def decode_pdf_string(token):
+    """Декодирует строку PDF — литерал (...) или шестнадцатеричную <...> — в байты."""
+    if token.startswith(b'<'):
+        hex_digits = re.sub(rb'\s', b'', token[1:-1])
+        if len(hex_digits) % 2:
+            hex_digits += b'0'
+        return bytes.fromhex(hex_digits.decode('ascii'))
+
+    def unescape(match):
+        escaped = match.group(1)
+        if escaped[:1].isdigit():
+            return bytes([int(escaped, 8) & 0xFF])
+        return PDF_ESCAPES.get(escaped, escaped)
+
+    return PDF_ESCAPE_RE.sub(unescape, token[1:-1])
+
+
+def starts_new_line(gap, operator):
+    """Начинается ли фрагмент с новой строки — по оператору вывода и операторам между фрагментами."""
+    if operator in (b"'", b'"'):
+        return True
+    for match in LINE_BREAK_RE.finditer(gap):
+        if match.group(2) is None or float(match.group(2)) != 0:
+            return True
+    return False
+
+
+def content_text_runs(content):
+    """
+    Текстовые фрагменты потока содержимого в порядке вывода.
+    Для каждого фрагмента возвращается текст и признак того, что он начинается с новой строки.
+    Массив TJ разрывается на фрагменты той же строки по ненулевым смещениям: extract_text() вставляет там пробел,
+    если смещение не меньше половины ширины пробела шрифта, а ширина шрифта здесь неизвестна.
+    """
+    runs = []
+    previous_end = 0
+    for match in TEXT_RUN_RE.finditer(content):
+        new_line = starts_new_line(content[previous_end:match.start()], match.group(3))
+        if match.group(1) is not None:
+            pieces = [[]]
+            for item in TJ_ITEM_RE.finditer(match.group(1)):
+                if item.group(1) is None:
+                    pieces[-1].append(decode_pdf_string(item.group(0)))
+                elif pieces[-1] and float(item.group(1)) != 0:
+                    pieces.append([])
+            for piece in pieces:
+                if piece:
+                    runs.append((b''.join(piece).decode('latin-1'), new_line))
+                    new_line = False
+        else:
+            runs.append((decode_pdf_string(match.group(2)).decode('latin-1'), new_line))
+        previous_end = match.end()
+    return runs
+
+
+def scan_sticker_fast(page, fbs_prefixes):
+    """
+    Ищет стикер прямо в текстовых операторах потока содержимого страницы, без разметки extract_text().
+    Возвращает None, если найти не удалось или номер может продолжаться в следующем фрагменте на той же строке
+    (в том числе после смещения в массиве TJ, где extract_text() мог вставить пробел), — тогда решает полное
+    извлечение текста.
+    """
+    contents = page.get_contents()
+    if contents is None:
+        return None
+    data = contents.get_data()
+    if b'FBS' not in data:
+        return None
+
+    runs = content_text_runs(data)
+    pattern = sticker_pattern(fbs_prefixes)
+    for i, (run, _) in enumerate(runs):
+        match = pattern.search(run)
+        if match is None:
+            continue
+        if match.end() == len(run) and i + 1 < len(runs):
+            next_run, next_on_new_line = runs[i + 1]
+            if not next_on_new_line and next_run[:1].isdigit():
+                return None
+        return match.group(1), match.group(2)
+    return None
+
+
+def find_sticker_on_page(page, fbs_prefixes, fast_scan=True):
+    """
+    Ищет стикер на странице: сначала быстрым просмотром текстовых операторов, затем полным извлечением текста.
+    Возвращает пару (префикс, номер) или None.
+    """
+    if fast_scan:
+        try:
+            sticker = scan_sticker_fast(page, fbs_prefixes)
+        except Exception:
+            sticker = None
+        if sticker:
+            return sticker
+    return find_sticker_in_text(page.extract_text(), fbs_prefixes)
+
+
+def open_worker_source(pdf_source):
+    """
+    Открывает файл документа в рабочем процессе: байты — из памяти, путь — отображением файла в память
+    (страницы файла общие для всех процессов через кэш ОС, а не копия в памяти каждого).
+    """
+    if isinstance(pdf_source, str):
+        with open(pdf_source, 'rb') as pdf_file:
+            return PdfReader(mmap.mmap(pdf_file.fileno(), 0, access=mmap.ACCESS_READ))
+    return PdfReader(io.BytesIO(pdf_source))
+
+
+def init_pdf_worker(pdf_sources):
+    """
+    Открывает PDF один раз на рабочий процесс; страницы нескольких файлов нумеруются подряд, как в документе.
+    pdf_sources — байты или пути файлов (см. open_worker_source).
+    """
+    global _worker_readers, _worker_first_pages
+    _worker_readers = [open_worker_source(pdf_source) for pdf_source in pdf_sources]
+    _worker_first_pages = []
+    first_page = 1
+    for reader in _worker_readers:
+        _worker_first_pages.append(first_page)
+        first_page += len(reader.pages)
+
+
+def worker_page(page_num):
+    """Страница по сквозному номеру (с 1) среди файлов, открытых в рабочем процессе."""
+    source = bisect_right(_worker_first_pages, page_num) - 1
+    return _worker_readers[source].pages[page_num - _worker_first_pages[source]]
+
+
+def extract_sticker_pages(page_numbers, fbs_prefixes, fast_scan=True):
+    """Извлекает стикеры с перечисленных страниц (нумерация с 1) в рабочем процессе: {страница: (префикс, номер)}."""
+    sticker_data = {}
+    for page_num in page_numbers:
+        sticker = find_sticker_on_page(worker_page(page_num), fbs_prefixes, fast_scan)
+        if sticker:
+            sticker_data[page_num] = sticker
+    return sticker_data
+
+
+def split_page_ranges(num_pages, num_chunks):
+    """Делит диапазон страниц на последовательные непересекающиеся части."""
+    num_chunks = max(1, min(num_chunks, num_pages))
+    chunk_size, remainder = divmod(num_pages, num_chunks)
+    ranges = []
+    start = 0
+    for i in range(num_chunks):
+        stop = start + chunk_size + (1 if i < remainder else 0)
+        ranges.append((start, stop))
+        start = stop
+    return ranges
+
+
+def effective_workers(num_pages, workers):
+    """Число процессов, которое имеет смысл запускать для данного числа страниц."""
+    return max(1, min(workers, num_pages // MIN_PAGES_PER_WORKER))
+
+
+def pool_context():
+    """
+    Способ запуска рабочих процессов. Пулы создаются из потоков фоновых задач, пока работают другие потоки
+    (задачи других сессий, сервер Streamlit), а fork в многопоточном процессе небезопасен: дочерний процесс
+    может унаследовать чужую захваченную блокировку. Поэтому процессы запускаются через forkserver, а где его
+    нет (Windows) — через spawn. Функции и аргументы рабочих процессов для этого и лежат в этом модуле;
+    PDF из памяти передаётся процессам байтами, файл на диске — путём (см. open_worker_source).
+    """
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+
+
+def extract_stickers_parallel(pdf_sources, fbs_prefixes, page_numbers, workers, fast_scan=True, page_progress=None):
+    """
+    Извлекает стикеры с перечисленных страниц в пуле процессов; pdf_sources — байты или пути всех файлов документа.
+    Результаты частей объединяются по порядку, поэтому словарь совпадает с последовательным извлечением.
+    page_progress(готово, всего) вызывается после каждой части.
+    """
+    ranges = split_page_ranges(len(page_numbers), workers * CHUNKS_PER_WORKER)
+    chunks = [page_numbers[start:stop] for start, stop in ranges]
+    sticker_data = {}
+    with ProcessPoolExecutor(max_workers=workers, mp_context=pool_context(), initializer=init_pdf_worker,
+                             initargs=(pdf_sources,)) as executor:
+        for (_, stop), chunk in zip(ranges, executor.map(extract_sticker_pages, chunks, [fbs_prefixes] * len(chunks),
+                                                          [fast_scan] * len(chunks))):
+            sticker_data.update(chunk)
+            if page_progress is not None:
+                page_progress(stop, len(page_numbers))
+    return sticker_data
+
+
+def compact_pdf_writer(writer):
+    """
+    Сливает одинаковые объекты собранного PDF в один и убирает объекты, на которые ничего не ссылается.
+    Общие для нескольких страниц объекты PdfWriter и так не копирует, но генераторы этикеток часто
+    встраивают один и тот же шрифт или логотип в каждую страницу отдельно — такие копии и сливаются.
+    """
+    writer.compress_identical_objects()
+    return writer
+
+
+def write_page_batch(page_numbers, compact=False):
+    """Собирает PDF из перечисленных страниц (нумерация с 1) в рабочем процессе и возвращает его байты."""
+    writer = PdfWriter()
+    for page_num in page_numbers:
+        writer.add_page(worker_page(page_num))
+    if compact:
+        compact_pdf_writer(writer)
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
+
+
+def write_batches_parallel(pdf_sources, batches, workers, compact=False):
+    """
+    Записывает пачки страниц в пуле процессов и отдаёт байты PDF по одной пачке в порядке пачек,
+    чтобы вызывающий код мог сразу записать пачку и не держать в памяти все.
+    """
+    with ProcessPoolExecutor(max_workers=workers, mp_context=pool_context(), initializer=init_pdf_worker,
+                             initargs=(pdf_sources,)) as executor:
+        yield from executor.map(write_page_batch, batches, [compact] * len(batches))